@@ -0,0 +1,116 @@
+import argparse
+import asyncio
+import gc
+import importlib.util
+import os
+import tracemalloc
+
+# usage: python bench-memory.py [--counts 10000 50000] [--top N]
+#
+# Bytes per idle connection. The server module is imported and N sessions
+# are joined the way handle_client does it (Session, Outbox and its writer
+# task, registry, lobby) over a stand-in socket: first once to read the
+# RSS growth, then again under tracemalloc to see which lines the memory
+# comes from. That is the server's own per-connection state; the
+# websockets connection objects come on top (wirechat-loadgen.py reports
+# the RSS of a real server). Linux only (RSS comes from /proc).
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_PATH = os.path.join(BENCH_DIR, "..", "server", "wirechat-server.py")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Wirechat per-connection memory")
+    p.add_argument("--counts", type=int, nargs="+", default=[10000, 50000], help="connections (default 10000 50000)")
+    p.add_argument("--top", type=int, default=8, help="allocation sites listed (default 8)")
+    return p.parse_args()
+
+
+def load_server():
+    spec = importlib.util.spec_from_file_location("wirechat_server", SERVER_PATH)
+    server = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(server)
+    return server
+
+
+def rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * PAGE_SIZE
+
+
+class IdleSocket:
+    """Stands in for a websockets connection that never sends or receives."""
+
+    def __init__(self, n):
+        self.remote_address = ("127.0.0.1", n)
+
+    async def send(self, message, text=None):
+        pass
+
+    async def close(self, code=1000, reason=""):
+        pass
+
+
+async def join_all(server, sockets):
+    lobby = server.rooms[server.DEFAULT_ROOM]
+    for i, ws in enumerate(sockets):
+        session = server.Session(ws, f"user{i}")
+        server.sessions.add(session)
+        session.outbox = server.Outbox(ws, session.nickname)
+        server.enter_room(session, lobby)
+
+    # let every writer task start and park on its empty queue
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+
+
+async def leave_all(server):
+    for session in list(server.sessions.by_ws.values()):
+        session.outbox.stop()
+        server.sessions.remove(session.ws)
+        server.leave_room(session)
+    await asyncio.sleep(0)
+
+
+async def measure(server, n, top):
+    sockets = [IdleSocket(i) for i in range(n)]
+
+    gc.collect()
+    before = rss()
+    await join_all(server, sockets)
+    gc.collect()
+    grown = rss() - before
+    await leave_all(server)
+
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.take_snapshot()
+    await join_all(server, sockets)
+    gc.collect()
+    end = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    await leave_all(server)
+
+    sites = end.compare_to(start, "lineno")
+    traced = sum(stat.size_diff for stat in sites)
+    print(f"{n} sessions: {grown / n:,.0f} B/conn RSS, {traced / n:,.0f} B/conn traced")
+    for stat in sites[:top]:
+        frame = stat.traceback[0]
+        print(f"    {stat.size_diff / n:8,.0f} B  {os.path.basename(frame.filename)}:{frame.lineno}")
+
+
+async def run(args):
+    server = load_server()
+    server.open_room(server.DEFAULT_ROOM)
+    for n in args.counts:
+        await measure(server, n, args.top)
+
+
+def main():
+    args = parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
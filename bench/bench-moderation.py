@@ -0,0 +1,151 @@
+import importlib.util
+import os
+import random
+import re
+import sys
+import time
+
+# usage: python bench-moderation.py [messages] [rounds]
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_PATH = os.path.join(BENCH_DIR, "..", "server", "wirechat-server.py")
+
+COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+ROUNDS = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+FILLER = (
+    "the quick brown fox jumps over lazy dog hello there general kenobi "
+    "wirechat server client message replay socket frame python asyncio "
+    "cup ball baby juice pipeline hot pocket anna lysis class glass pass"
+).split()
+
+
+def load_server():
+    spec = importlib.util.spec_from_file_location("wirechat_server", SERVER_PATH)
+    server = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(server)
+    return server
+
+
+def legacy_patterns(words):
+    # the per-entry pattern list the server used before build_matcher()
+    patterns = []
+    for word in words:
+        escaped = re.escape(word)
+        if " " in word:
+            patterns.append(re.compile(escaped, re.IGNORECASE))
+            patterns.append(re.compile(re.escape(word.replace(" ", "")), re.IGNORECASE))
+        else:
+            patterns.append(re.compile(rf"\b{escaped}\b", re.IGNORECASE))
+    return patterns
+
+
+def legacy_contains(patterns, normalise, text):
+    norm = normalise(text)
+    for pattern in patterns:
+        if pattern.search(norm):
+            return True
+    return False
+
+
+def make_message(rng, length, forbidden, dirty):
+    words = []
+    size = 0
+    while size < length:
+        word = rng.choice(FILLER)
+        words.append(word)
+        size += len(word) + 1
+
+    if dirty:
+        words.insert(rng.randrange(len(words)), rng.choice(forbidden))
+
+    return " ".join(words)[:length]
+
+
+def mutations(word):
+    # near misses around the word-boundary and merged-phrase rules
+    yield word
+    yield word.upper()
+    yield "x" + word
+    yield word + "x"
+    yield word.replace(" ", "")
+    yield word.replace(" ", "_")
+    yield word.replace(" ", "  ")
+    yield word[:-1]
+    yield f"({word})"
+    yield word.replace("s", "\u017f").replace("i", "\u0131")
+
+
+def timed(fn, messages):
+    best = None
+    hits = 0
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        hits = sum(1 for text in messages if fn(text))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, hits
+
+
+def main():
+    server = load_server()
+    rng = random.Random(1234)
+
+    start = time.perf_counter()
+    patterns = legacy_patterns(server.FORBIDDEN)
+    legacy_build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matcher = server.build_matcher(server.FORBIDDEN)
+    matcher_build = time.perf_counter() - start
+
+    def legacy(text):
+        return legacy_contains(patterns, server.normalise, text)
+
+    def single(text):
+        return matcher.search(server.normalise(text)) is not None
+
+    # --- same verdicts ---
+    corpus = [m for word in server.FORBIDDEN for m in mutations(word)]
+    corpus += [make_message(rng, 200, server.FORBIDDEN, i % 2 == 0) for i in range(500)]
+    mismatches = [text for text in corpus if legacy(text) != single(text)]
+
+    print(f"patterns:      {len(patterns)} (from {len(server.FORBIDDEN)} entries)")
+    print(f"build time:    legacy {legacy_build * 1000:.1f}ms | matcher {matcher_build * 1000:.1f}ms")
+    print(f"verdict check: {len(corpus)} texts, {len(mismatches)} mismatches")
+    for text in mismatches[:10]:
+        print(f"  MISMATCH {text!r}")
+
+    # --- speed at MAX_MSG_LEN ---
+    length = server.MAX_MSG_LEN
+    plain = [make_message(rng, length, server.FORBIDDEN, False) for _ in range(COUNT)]
+    seeded = [make_message(rng, length, server.FORBIDDEN, True) for _ in range(COUNT)]
+
+    for label, messages in (("plain", plain), ("seeded", seeded)):
+        legacy_time, legacy_hits = timed(legacy, messages)
+        single_time, single_hits = timed(single, messages)
+        print(
+            f"{label} x{len(messages)} @ {length} chars: "
+            f"legacy {legacy_time / len(messages) * 1e6:.1f}us/msg ({legacy_hits} hits) | "
+            f"matcher {single_time / len(messages) * 1e6:.1f}us/msg ({single_hits} hits) | "
+            f"{legacy_time / single_time:.1f}x"
+        )
+
+    # --- flood: the same few lines over and over, through the verdict cache ---
+    flood = [plain[i % 10] for i in range(COUNT)]
+    server.moderation_cache.clear()
+    single_time, _ = timed(single, flood)
+    cached_time, _ = timed(server.contains_forbidden, flood)
+    print(
+        f"flood x{len(flood)} (10 distinct): "
+        f"matcher {single_time / len(flood) * 1e6:.1f}us/msg | "
+        f"cached {cached_time / len(flood) * 1e6:.1f}us/msg "
+        f"({server.stats['moderation_hits']} hits, {server.stats['moderation_misses']} misses) | "
+        f"{single_time / cached_time:.1f}x"
+    )
+
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
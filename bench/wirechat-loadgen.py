@@ -0,0 +1,565 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from array import array
+from datetime import datetime
+
+import websockets
+
+# usage: python wirechat-loadgen.py [--clients N] [--rate MSGS_PER_S] [--duration S] ...
+#
+# Starts a throwaway copy of the server (own temp dir, free ports, rate
+# limits lifted), connects --clients synthetic clients and has --senders of
+# them send MSG/IMG at --rate messages per second in total. Every client
+# reads everything it is sent; the send time is embedded in the message, so
+# the delivery latency is measured end to end inside this one process.
+# Frames the server still throttled are read from its /metrics and
+# reported: with them the numbers measure the rate limiter, not the server.
+#
+# Linux only: server CPU and RSS come from /proc.
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.join(BENCH_DIR, "..", "server")
+
+MARK = "lg~"  # payload marker, followed by the perf_counter() send time
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# written to the copy's config/server.txt unless --server-limits
+UNLIMITED = "1000000/1000000"
+RATE_SETTINGS = ("RATE_MSG", "RATE_IMG", "RATE_CMD", "RATE_GLOBAL")
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Wirechat load generator")
+    p.add_argument("--clients", type=int, default=500, help="steady connections (default 500)")
+    p.add_argument("--senders", type=int, default=50, help="how many of them send (default 50)")
+    p.add_argument("--rate", type=float, default=50, help="messages per second, all senders together")
+    p.add_argument("--duration", type=float, default=20, help="measured seconds (default 20)")
+    p.add_argument("--img", type=float, default=0.0, help="fraction of IMG instead of MSG (0-1)")
+    p.add_argument("--size", type=int, default=64, help="MSG text length in characters")
+    p.add_argument("--churn", type=float, default=0.0, help="extra clients joining and leaving per second")
+    p.add_argument("--connect-concurrency", type=int, default=200, help="handshakes in flight during ramp-up")
+    p.add_argument("--workers", type=int, default=1, help="WIRECHAT_WORKERS for the spawned server")
+    p.add_argument("--url", help="use a running server instead of starting one")
+    p.add_argument("--pid", type=int, help="with --url: server pid to sample CPU/RSS from")
+    p.add_argument("--metrics-port", type=int, help="with --url: the server's metrics port, for throttled counts")
+    p.add_argument("--server-limits", action="store_true",
+                   help="keep the spawned server's rate limits instead of lifting them")
+    p.add_argument("--drain", type=float, default=3, help="seconds to wait for in-flight frames at the end")
+    p.add_argument("--output", default="loadgen-results.json", help="where to write the JSON results")
+    p.add_argument("--baseline", help="earlier results file to compare against")
+    p.add_argument("--tolerance", type=float, default=0.2,
+                   help="with --baseline: allowed p99 / throughput regression (default 0.2 = 20%%)")
+    p.add_argument("--batch", action="store_true", help="clients opt in to CAPS batch (packed frames)")
+    p.add_argument("--seed", type=int, default=1234)
+    return p.parse_args()
+
+
+# ---------- server process ----------
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(workers, server_limits):
+    """Run a copy of the server from a temp dir, so logs and replay start empty."""
+    workdir = tempfile.mkdtemp(prefix="wirechat-loadgen-")
+    shutil.copy(os.path.join(SERVER_DIR, "wirechat-server.py"), workdir)
+    shutil.copytree(os.path.join(SERVER_DIR, "config"), os.path.join(workdir, "config"))
+
+    if not server_limits:
+        # later lines win, so this overrides whatever the copied file says
+        with open(os.path.join(workdir, "config", "server.txt"), "a", encoding="utf-8") as f:
+            f.write("\n" + "".join(f"{name}={UNLIMITED}\n" for name in RATE_SETTINGS))
+
+    port = free_port()
+    metrics_port = free_port()  # workers use metrics_port + their id
+    env = dict(
+        os.environ,
+        WIRECHAT_PORT=str(port),
+        WIRECHAT_METRICS_PORT=str(metrics_port),
+        WIRECHAT_WORKERS=str(workers),
+    )
+    env.setdefault("WIRECHAT_ADMIN_TOKEN", "loadgen")
+
+    proc = subprocess.Popen(
+        [sys.executable, "wirechat-server.py"],
+        cwd=workdir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    return proc, port, metrics_port, workdir
+
+
+async def wait_for_port(port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"server did not come up on port {port}")
+
+
+def stop_server(proc, workdir):
+    proc.terminate()
+    try:
+        proc.wait(timeout=20)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def process_tree(pid):
+    # the server and, in multi-process mode, its workers
+    pids = [pid]
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+            if int(fields[1]) == pid:
+                pids.append(int(entry))
+    return pids
+
+
+def sample_process(pid):
+    """(cpu seconds, rss bytes) summed over the server's process tree."""
+    cpu = 0.0
+    rss = 0
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{p}/statm") as f:
+                pages = int(f.read().split()[1])
+        except OSError:
+            continue
+        cpu += (int(fields[11]) + int(fields[12])) / CLK_TCK  # utime + stime
+        rss += pages * PAGE_SIZE
+    return cpu, rss
+
+
+async def scrape_throttled(port, workers):
+    """wirechat_throttled_total per bucket, summed over the workers."""
+    throttled = {}
+    for worker_id in range(workers):
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port + worker_id)
+            writer.write(b"GET /metrics HTTP/1.1\r\nHost: loadgen\r\n\r\n")
+            body = (await reader.read()).decode("utf-8", "replace")
+            writer.close()
+        except OSError:
+            continue
+
+        for line in body.splitlines():
+            if line.startswith('wirechat_throttled_total{bucket="'):
+                labels, _, value = line.rpartition(" ")
+                bucket = labels.split('"')[1]
+                throttled[bucket] = throttled.get(bucket, 0) + int(float(value))
+    return throttled
+
+
+# ---------- clients ----------
+
+class Results:
+    def __init__(self):
+        self.latencies = array("d")  # seconds, one per delivered bench frame
+        self.handshakes = array("d")
+        self.sent = 0
+        self.received = 0
+        self.handshake_errors = 0
+        self.send_errors = 0
+        self.disconnects = 0
+        self.errors = {}  # first word of unexpected ERR frames -> count
+
+    def error(self, frame):
+        key = frame[:40]
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+
+class Client:
+    batch = False  # send CAPS batch before NICK
+
+    def __init__(self, nickname, url, results):
+        self.nickname = nickname
+        self.url = url
+        self.results = results
+        self.ws = None
+        self.joined = asyncio.Event()
+        self.reader = None
+        self.closing = False
+
+    async def connect(self):
+        start = time.perf_counter()
+        try:
+            self.ws = await websockets.connect(self.url, max_queue=None, ping_interval=None)
+            if self.batch:
+                await self.ws.send("CAPS batch")
+            await self.ws.send(f"NICK {self.nickname}")
+            self.reader = asyncio.create_task(self.read())
+            await asyncio.wait_for(self.joined.wait(), timeout=30)
+        except Exception:
+            self.results.handshake_errors += 1
+            await self.close()
+            return False
+
+        self.results.handshakes.append(time.perf_counter() - start)
+        return True
+
+    async def read(self):
+        joined = f"SYS {self.nickname} joined the chat!"
+        replaying = False
+        results = self.results
+
+        try:
+            async for frame in self.ws:
+                for line in frame.split("\n") if self.batch else (frame,):
+                    if line.startswith("MSG ") or line.startswith("IMG "):
+                        if replaying:
+                            continue
+                        _, mark, sent = line.rpartition(MARK)
+                        if mark:
+                            results.latencies.append(time.perf_counter() - float(sent))
+                            results.received += 1
+
+                    elif line == joined:
+                        self.joined.set()
+
+                    elif line.startswith("SYS Replay start"):
+                        replaying = True
+
+                    elif line == "SYS Replay end":
+                        replaying = False
+
+                    elif line.startswith("ERR"):
+                        results.error(line)
+
+        except websockets.ConnectionClosed:
+            pass
+
+        finally:
+            if self.joined.is_set() and not self.closing:
+                results.disconnects += 1  # the server hung up on us
+
+    async def send(self, kind, filler):
+        stamp = f"{MARK}{time.perf_counter():.6f}"
+        if kind == "IMG":
+            frame = f"IMG https://bench.invalid/{stamp}"
+        else:
+            frame = f"MSG {filler} {stamp}"
+
+        try:
+            await self.ws.send(frame)
+            self.results.sent += 1
+        except Exception:
+            self.results.send_errors += 1
+
+    async def close(self):
+        self.closing = True
+        if self.ws is not None:
+            try:
+                await self.ws.send("QUIT")
+                await self.ws.close()
+            except Exception:
+                pass
+        if self.reader is not None:
+            try:
+                await asyncio.wait_for(self.reader, timeout=5)
+            except (asyncio.TimeoutError, Exception):
+                self.reader.cancel()
+
+
+async def connect_all(clients, concurrency):
+    gate = asyncio.Semaphore(concurrency)
+
+    async def one(client):
+        async with gate:
+            return await client.connect()
+
+    ok = await asyncio.gather(*(one(c) for c in clients))
+    return [c for c, joined in zip(clients, ok) if joined]
+
+
+async def sender(client, interval, args, rng, stop):
+    filler = ("x" * args.size)[:max(0, args.size - 20)]
+    await asyncio.sleep(rng.random() * interval)  # spread senders over the interval
+    next_at = time.perf_counter()
+
+    while not stop.is_set():
+        kind = "IMG" if rng.random() < args.img else "MSG"
+        await client.send(kind, filler)
+
+        next_at += interval
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            await asyncio.sleep(0)  # we are behind; still let readers run
+
+
+async def churn(url, results, per_second, stop, rng):
+    """Open and close extra clients, per_second of each, while the test runs."""
+    count = 0
+    live = []
+    tasks = set()
+
+    while not stop.is_set():
+        count += 1
+        client = Client(f"lgc{count}", url, results)
+        task = asyncio.create_task(client.connect())
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        live.append(client)
+
+        if len(live) > max(1, int(per_second)):
+            old = live.pop(rng.randrange(len(live)))
+            task = asyncio.create_task(old.close())
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        await asyncio.sleep(1 / per_second)
+
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await asyncio.gather(*(c.close() for c in live))
+    return count
+
+
+# ---------- reporting ----------
+
+def percentiles(samples):
+    if not samples:
+        return {"count": 0}
+
+    ordered = sorted(samples)
+    n = len(ordered)
+
+    def at(q):
+        return round(ordered[min(n - 1, int(q * n))] * 1000, 3)
+
+    return {
+        "count": n,
+        "p50_ms": at(0.5),
+        "p99_ms": at(0.99),
+        "p999_ms": at(0.999),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def git_revision():
+    try:
+        out = subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=BENCH_DIR, capture_output=True, text=True, timeout=5,
+        )
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """Lines describing regressions against `baseline` (empty if none)."""
+    problems = []
+
+    old = baseline["delivery"].get("p99_ms")
+    new = results["delivery"].get("p99_ms")
+    if old and new and new > old * (1 + tolerance):
+        problems.append(f"delivery p99 {old}ms -> {new}ms")
+
+    old = baseline["throughput"]["delivered_per_s"]
+    new = results["throughput"]["delivered_per_s"]
+    if old and new < old * (1 - tolerance):
+        problems.append(f"delivered/s {old} -> {new}")
+
+    old = baseline["handshake"].get("p99_ms")
+    new = results["handshake"].get("p99_ms")
+    if old and new and new > old * (1 + tolerance):
+        problems.append(f"handshake p99 {old}ms -> {new}ms")
+
+    return problems
+
+
+def print_summary(r):
+    d, h, t, s = r["delivery"], r["handshake"], r["throughput"], r["server"]
+    print(f"clients:    {r['config']['clients']} ({h['count']} handshakes, {r['errors']['handshake']} failed)")
+    print(f"handshake:  {t['handshakes_per_s']}/s | p50 {h.get('p50_ms')}ms p99 {h.get('p99_ms')}ms")
+    print(f"sent:       {t['sent']} ({t['sent_per_s']}/s)")
+    print(f"delivered:  {d['count']} ({t['delivered_per_s']}/s, {d.get('ratio')} of expected)")
+    print(f"latency:    p50 {d.get('p50_ms')}ms p99 {d.get('p99_ms')}ms p999 {d.get('p999_ms')}ms "
+          f"max {d.get('max_ms')}ms")
+    if s:
+        print(f"server:     cpu {s['cpu_percent']}% | rss {s['rss_end_bytes'] // 1024} KiB "
+              f"(peak {s['rss_peak_bytes'] // 1024} KiB)")
+    print(f"loadgen:    cpu {r['loadgen']['cpu_percent']}%")
+    if r["throttled"]:
+        print(f"THROTTLED:  {', '.join(f'{name} {n}' for name, n in r['throttled'].items())} "
+              f"(the server's rate limits shaped this run)")
+    if r["errors"]["frames"]:
+        print(f"ERR frames: {r['errors']['frames']}")
+
+
+# ---------- main ----------
+
+async def run(args):
+    rng = random.Random(args.seed)
+    proc = workdir = None
+    pid = args.pid
+    url = args.url
+    metrics_port = args.metrics_port
+
+    if url is None:
+        proc, port, metrics_port, workdir = start_server(args.workers, args.server_limits)
+        pid = proc.pid
+        url = f"ws://127.0.0.1:{port}"
+
+    try:
+        if proc is not None:
+            await wait_for_port(port)
+            await asyncio.sleep(0.5 if args.workers > 1 else 0)  # workers attach to the bus
+
+        results = Results()
+        Client.batch = args.batch
+        clients = [Client(f"lg{i}", url, results) for i in range(args.clients)]
+
+        # --- ramp-up ---
+        ramp_start = time.perf_counter()
+        clients = await connect_all(clients, args.connect_concurrency)
+        ramp_time = time.perf_counter() - ramp_start
+        handshakes = len(results.handshakes)
+
+        # --- measured run ---
+        senders = clients[:args.senders]
+        interval = len(senders) / args.rate if senders and args.rate > 0 else None
+        stop = asyncio.Event()
+
+        throttled0 = await scrape_throttled(metrics_port, args.workers) if metrics_port else {}
+        cpu0 = sample_process(pid)[0] if pid else None
+        own0 = resource.getrusage(resource.RUSAGE_SELF)
+        rss_peak = 0
+        start = time.perf_counter()
+
+        tasks = []
+        if interval:
+            tasks += [asyncio.create_task(sender(c, interval, args, rng, stop)) for c in senders]
+        churner = None
+        if args.churn > 0:
+            churner = asyncio.create_task(churn(url, results, args.churn, stop, rng))
+
+        while time.perf_counter() - start < args.duration:
+            await asyncio.sleep(1)
+            if pid:
+                rss_peak = max(rss_peak, sample_process(pid)[1])
+
+        stop.set()
+        elapsed = time.perf_counter() - start
+        await asyncio.gather(*tasks)
+        churned = await churner if churner else 0
+        await asyncio.sleep(args.drain)
+
+        server = {}
+        if pid:
+            cpu1, rss = sample_process(pid)
+            server = {
+                "cpu_seconds": round(cpu1 - cpu0, 3),
+                "cpu_percent": round((cpu1 - cpu0) / elapsed * 100, 1),
+                "rss_end_bytes": rss,
+                "rss_peak_bytes": max(rss_peak, rss),
+            }
+        throttled = {}
+        if metrics_port:
+            for name, n in (await scrape_throttled(metrics_port, args.workers)).items():
+                if n - throttled0.get(name, 0):
+                    throttled[name] = n - throttled0.get(name, 0)
+        own1 = resource.getrusage(resource.RUSAGE_SELF)
+        own_cpu = (own1.ru_utime + own1.ru_stime) - (own0.ru_utime + own0.ru_stime)
+
+        await asyncio.gather(*(c.close() for c in clients))
+
+    finally:
+        if proc is not None:
+            stop_server(proc, workdir)
+
+    # every message goes to every client that is joined at the time; with
+    # churn the expected count is only approximate
+    expected = results.sent * len(clients)
+    delivery = percentiles(results.latencies)
+    delivery["ratio"] = round(results.received / expected, 4) if expected else None
+
+    return {
+        "tool": "wirechat-loadgen",
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")},
+        "delivery": delivery,
+        "handshake": percentiles(results.handshakes[:handshakes]),
+        "throughput": {
+            "sent": results.sent,
+            "sent_per_s": round(results.sent / elapsed, 1),
+            "delivered_per_s": round(results.received / elapsed, 1),
+            "handshakes_per_s": round(handshakes / ramp_time, 1) if ramp_time else None,
+            "churned_clients": churned,
+            "seconds": round(elapsed, 3),
+        },
+        "server": server,
+        "loadgen": {"cpu_percent": round(own_cpu / elapsed * 100, 1)},
+        "throttled": throttled,  # frames per rate-limit bucket, during the measured run
+        "errors": {
+            "handshake": results.handshake_errors,
+            "send": results.send_errors,
+            "disconnects": results.disconnects,
+            "frames": results.errors,
+        },
+    }
+
+
+def raise_fd_limit():
+    # every client is a socket; the default soft limit is often 1024
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+    args = parse_args()
+    raise_fd_limit()
+    results = asyncio.run(run(args))
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+        f.write("\n")
+
+    print_summary(results)
+    print(f"results:    {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        problems = compare(results, baseline, args.tolerance)
+        for line in problems:
+            print(f"REGRESSION {line}")
+        if problems:
+            return 1
+        print(f"no regressions against {args.baseline}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
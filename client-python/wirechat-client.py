@@ -1,6 +1,10 @@
 import asyncio
 import websockets
 import sys
+import time
+import random
+import re
+from collections import deque
 
 VERSION = "1.2.3"  #* Major.Minor.Patch
 
@@ -9,6 +13,7 @@ if not sys.stdout.isatty():
     COLOURS = False
 
 LOCALUNSECURE = False
+AUTO_RECONNECT = True
 
 # ---------- colours ----------
 
@@ -41,6 +46,8 @@ if len(sys.argv) > 1:
     COLOURS = str_to_bool(sys.argv[1])
 if len(sys.argv) > 2:
     LOCALUNSECURE = str_to_bool(sys.argv[2])
+if len(sys.argv) > 3:
+    AUTO_RECONNECT = str_to_bool(sys.argv[3])
 
 
 def local_valid_nickname(nick):
@@ -62,22 +69,112 @@ def colourise(message):
         return f"{RED}{message}{RESET}"
 
     if message.startswith("MSG "):
-        try:
-            prefix, rest = message.split(" ", 1)
-            ts, rest = rest.split("] ", 1)
-            name, text = rest.split(": ", 1)
-
-            return (
-                f"{DIM}[{prefix}]{RESET} "
-                f"{DIM}[{ts.lstrip('[')}]{RESET} "
-                f"{GREEN}{name}{RESET}: {text}"
-            )
-        except ValueError:
+        # partition, not split: this runs for every line in a busy room
+        ts, found_ts, rest = message[4:].partition("] ")
+        name, found_name, text = rest.partition(": ")
+        if not (found_ts and found_name):
             return f"{GREEN}{message}{RESET}"
 
+        return (
+            f"{DIM}[MSG]{RESET} "
+            f"{DIM}[{ts.lstrip('[')}]{RESET} "
+            f"{GREEN}{name}{RESET}: {text}"
+        )
+
     return message
 
 
+# ---------- rendering ----------
+
+RENDER_INTERVAL = 1 / 30   # seconds between terminal writes
+RENDER_MAX_LINES = 200     # MSG/IMG lines per write; older ones are counted as skipped
+RENDER_LAG_WARN = 1.0      # say so when lines wait longer than this (seconds)
+RENDER_WARN_EVERY = 5.0    # ... but not more often than this
+
+
+class Renderer:
+    """Collects incoming lines and writes them to the terminal in batches.
+
+    The receiver only appends; run() formats whatever piled up and writes
+    it with one flush, at most once per RENDER_INTERVAL. When more chat
+    lines arrive than RENDER_MAX_LINES per write, the oldest are replaced
+    by a "N messages skipped" line.
+    """
+
+    CHAT = ("MSG ", "IMG ")
+
+    def __init__(self):
+        self.pending = deque()  # (arrival time, line)
+        self.wakeup = None
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.last_warning = 0.0
+        self.rendered = 0
+        self.skipped = 0
+        self.writes = 0
+
+    def put(self, line):
+        self.pending.append((time.perf_counter(), line))
+        if self.wakeup:
+            self.wakeup.set()
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                self.flush()
+                await asyncio.sleep(RENDER_INTERVAL)
+        finally:
+            self.wakeup = None
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        lines, self.pending = self.pending, deque()
+        now = time.perf_counter()
+
+        chat = sum(1 for _, line in lines if line.startswith(self.CHAT))
+        skip = max(0, chat - RENDER_MAX_LINES)
+        skipped = 0
+
+        out = []
+        for _, line in lines:
+            if skip and line.startswith(self.CHAT):
+                skip -= 1
+                skipped += 1
+                if not skip:
+                    out.append(colourise(f"LOCALSYS {skipped} messages skipped"))
+                continue
+            out.append(colourise(line))
+
+        self.last_lag = now - lines[0][0]
+        self.max_lag = max(self.max_lag, self.last_lag)
+        if self.last_lag > RENDER_LAG_WARN and now - self.last_warning > RENDER_WARN_EVERY:
+            self.last_warning = now
+            out.append(colourise(f"LOCALSYS Falling behind: {self.last_lag:.1f}s ({self.skipped + skipped} skipped)"))
+
+        self.rendered += len(lines) - skipped
+        self.skipped += skipped
+        self.writes += 1
+
+        sys.stdout.write("\n".join(out) + "\n")
+        sys.stdout.flush()
+
+    def report(self):
+        return (
+            f"LOCALSYS Render lag: {self.last_lag * 1000:.0f}ms (max {self.max_lag * 1000:.0f}ms) | "
+            f"Queued: {len(self.pending)} | "
+            f"Shown: {self.rendered} lines in {self.writes} writes | "
+            f"Skipped: {self.skipped}"
+        )
+
+
+renderer = Renderer()
+
+
 # ---------- connection info ----------
 
 host = input(f"{YELLOW}Host (default: chat.sneezless.com): {RESET}").strip() or "chat.sneezless.com"
@@ -87,6 +184,60 @@ port = int(port_input) if port_input else 443
 
 nickname = None
 
+WANTED_CAPS = ("batch", "seq")  # protocol extensions we understand
+caps_sent = False               # CAPS already sent on this connection
+last_seq = None                 # newest message seen, for REPLAY SINCE on reconnect
+
+# ---------- reconnecting ----------
+
+CONNECT_TIMEOUT = 10            # seconds for the TCP + WebSocket handshake
+RECONNECT_BASE = 1              # first retry after about this many seconds ...
+RECONNECT_MAX = 60              # ... doubling up to this
+RECONNECT_RESET = 30            # a connection that lasted this long starts the backoff over
+
+RETRY_RE = re.compile(r"retry in (\d+(?:\.\d+)?)s")
+# the lines whose "retry in Ns" is about reconnecting; others (such as the
+# rate limit's) are about the frame that was just refused. A server over
+# its connection caps says when to come back in Retry-After instead (see
+# run_client)
+RETRY_FROM = ("SYS Server restarting", "SYS Server shutting down")
+NICK_ERRORS = ("ERR Invalid nickname", "ERR Nickname contains forbidden words")
+
+quitting = False                # the user asked to leave, do not reconnect
+retry_hint = None               # seconds, from the server's "retry in Ns" when it sent us away
+nick_rejected = None            # the ERR that refused our nickname
+joined = False                  # got in at least once with this nickname
+
+attempts = {
+    "total": 0,
+    "failed": 0,
+    "connect_times": deque(maxlen=50),  # seconds, successful handshakes
+    "connected_at": None,               # monotonic, current connection
+    "last_error": None,
+}
+
+
+def backoff(attempt):
+    # capped exponential, with "equal jitter": somewhere between half and
+    # all of it, so clients dropped together do not come back together
+    delay = min(RECONNECT_MAX, RECONNECT_BASE * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+def attempts_report():
+    times = attempts["connect_times"]
+    line = f"LOCALSYS Connects: {attempts['total']} ({attempts['failed']} failed)"
+    if times:
+        line += (
+            f" | Handshake: last {times[-1] * 1000:.0f}ms, "
+            f"avg {sum(times) / len(times) * 1000:.0f}ms, max {max(times) * 1000:.0f}ms"
+        )
+    if attempts["connected_at"] is not None:
+        line += f" | Connected for {time.monotonic() - attempts['connected_at']:.0f}s"
+    if attempts["last_error"]:
+        line += f" | Last error: {attempts['last_error']}"
+    return line
+
 
 # ---------- websocket handlers ----------
 
@@ -97,41 +248,111 @@ from websockets.exceptions import (
 )
 
 
+def strip_seq(message):
+    # "MSG <seq> [...]" (CAPS seq) -> remember <seq>, show "MSG [...]"
+    global last_seq
+
+    kind, _, rest = message.partition(" ")
+    seq, _, body = rest.partition(" ")
+    if seq.isdigit():
+        last_seq = int(seq)
+        return f"{kind} {body}"
+    return message
+
+
 async def receive(ws):
+    global caps_sent, retry_hint, nick_rejected, joined
+
     try:
-        async for msg in ws:
-            print(colourise(msg))
+        async for frame in ws:
+            # with CAPS batch one frame can carry several lines
+            for msg in frame.split("\n"):
+                if not msg:
+                    continue
+
+                if msg.startswith("SYS Capabilities: "):
+                    caps = [c for c in WANTED_CAPS if c in msg.split()[2:]]
+                    if caps and not caps_sent:
+                        caps_sent = True
+                        await ws.send("CAPS " + " ".join(caps))
+                    continue
+
+                if msg.startswith("MSG ") or msg.startswith("IMG "):
+                    msg = strip_seq(msg)
+
+                elif msg.startswith("SYS ") or msg.startswith("ERR "):
+                    hint = RETRY_RE.search(msg) if msg.startswith(RETRY_FROM) else None
+                    if hint:
+                        retry_hint = float(hint.group(1))
+                    elif msg.startswith(NICK_ERRORS) or (msg == "ERR Nickname already in use" and not joined):
+                        nick_rejected = msg
+                    elif msg == f"SYS {nickname} joined the chat!":
+                        joined = True
+
+                renderer.put(msg)
 
     except ConnectionClosedOK:
         pass
 
     except ConnectionClosedError:
-        print(colourise("SYS Disconnected."))
+        renderer.put("SYS Disconnected.")
 
     except asyncio.CancelledError:
         pass
 
 
+pending_input = None            # input() still running when the last connection dropped
+
+
+async def read_line():
+    # input() cannot be cancelled, so a read outlives the connection it
+    # started on and the next one picks it up instead of losing the line
+    global pending_input
+
+    if pending_input is None:
+        pending_input = asyncio.ensure_future(asyncio.to_thread(input, ""))
+    try:
+        return await asyncio.shield(pending_input)
+    finally:
+        if pending_input.done():
+            pending_input = None
+
+
 async def send(ws):
+    global quitting
+
     while True:
         try:
-            msg = await asyncio.to_thread(input, "")
+            msg = await read_line()
             msg = msg.strip()
 
             if not msg:
                 continue
 
             if msg.lower() in {"/quit", "/exit"}:
+                quitting = True
                 await ws.send("QUIT")
                 await ws.close()
                 break
 
-            if msg.lower() == "/who":
-                await ws.send("WHO")
+            if msg.lower() == "/who" or msg.lower().startswith("/who "):
+                await ws.send(f"WHO {msg[5:].strip()}".strip())
+                continue
+
+            if msg.lower().startswith("/join "):
+                await ws.send(f"JOIN {msg[6:].strip()}")
+                continue
+
+            if msg.lower() == "/part":
+                await ws.send("PART")
+                continue
+
+            if msg.lower() == "/rooms":
+                await ws.send("ROOMS")
                 continue
 
             if msg.lower() == "/version":
-                print(colourise(f"LOCALSYS Wirechat client v{VERSION}"))
+                renderer.put(f"LOCALSYS Wirechat client v{VERSION}")
                 await ws.send("VERSION")
                 continue
 
@@ -148,38 +369,67 @@ async def send(ws):
                 continue
 
             if msg.lower() == "/stats":
+                renderer.put(attempts_report())
                 await ws.send("STATS")
                 continue
 
+            if msg.lower() == "/lag":
+                renderer.put(renderer.report())
+                continue
+
             await ws.send(f"MSG {msg}")
 
         except ConnectionClosed:
-            print(colourise("SYS Connection closed by server."))
+            renderer.put("SYS Connection closed by server.")
             break
 
-        except (EOFError, KeyboardInterrupt):
+        except EOFError:
+            # no more input (e.g. stdin is not a terminal): keep listening
+            return
+
+        except KeyboardInterrupt:
+            quitting = True
             return
 
 
 # ---------- main connection ----------
 
 async def main():
+    global caps_sent
+
     uri = f"wss://{host}:{port}"
     if LOCALUNSECURE:
         uri = f"ws://{host}:{port}"
 
-    async with websockets.connect(uri) as ws:
+    attempts["total"] += 1
+    started = time.perf_counter()
+
+    async with websockets.connect(uri, open_timeout=CONNECT_TIMEOUT) as ws:
+        attempts["connect_times"].append(time.perf_counter() - started)
+        attempts["connected_at"] = time.monotonic()
+        caps_sent = False
+        render = asyncio.create_task(renderer.run())
         receiver = asyncio.create_task(receive(ws))
+        sender = None  # not started if the server hangs up during the handshake
 
         try:
+            if last_seq is not None:
+                # coming back: only fetch what we missed, instead of the
+                # usual join replay (this server numbered messages before)
+                caps_sent = True
+                await ws.send("CAPS " + " ".join(WANTED_CAPS))
+                await ws.send(f"REPLAY SINCE {last_seq}")
+
             await ws.send(f"NICK {nickname}")
 
             sender = asyncio.create_task(send(ws))
 
-            await asyncio.wait(
+            done, _ = await asyncio.wait(
                 {sender, receiver},
                 return_when=asyncio.FIRST_COMPLETED,
             )
+            if receiver not in done and not quitting:
+                await receiver
 
         finally:
             try:
@@ -187,46 +437,95 @@ async def main():
             except Exception:
                 pass
 
-            for task in (receiver, sender):
-                task.cancel()
+            for task in (receiver, sender, render):
+                if task is not None:
+                    task.cancel()
 
             await ws.close()
+            renderer.flush()
 
 
 # ---------- reconnect loop ----------
 
-async def run_client():
+def ask_nickname():
     global nickname
 
     while True:
-
-        # ---- nickname prompt + validation ----
-        while True:
+        if nickname:
+            nickname = input(f"{YELLOW}Choose a nickname (default: {nickname}): {RESET}").strip() or nickname
+        else:
             nickname = input(f"{YELLOW}Choose a nickname: {RESET}").strip()
 
-            if local_valid_nickname(nickname):
-                break
+        if local_valid_nickname(nickname):
+            return
+
+        print(f"{RED}Invalid nickname (1–20 chars, no spaces).{RESET}")
 
-            print(f"{RED}Invalid nickname (1–20 chars, no spaces).{RESET}")
 
+async def run_client():
+    global retry_hint, nick_rejected, joined
+
+    attempt = 0
+    while True:
+
+        # ---- nickname prompt + validation ----
+        # only when there is none yet or the server refused it; otherwise
+        # reconnects reuse the last one
+        if nickname is None or nick_rejected:
+            nick_rejected = None
+            joined = False
+            ask_nickname()
+
+        retry_hint = None
         try:
             await main()
 
-        except (OSError, websockets.InvalidURI, websockets.InvalidHandshake) as e:
-            print(f"{RED}Connection error: {e}{RESET}")
+        except (OSError, asyncio.TimeoutError, websockets.InvalidURI, websockets.InvalidHandshake) as e:
+            attempts["failed"] += 1
+            attempts["last_error"] = str(e) or type(e).__name__
+            print(f"{RED}Connection error: {attempts['last_error']}{RESET}")
+
+            # a full server answers 503 and says when to come back
+            if isinstance(e, websockets.InvalidStatus):
+                retry_after = e.response.headers.get("Retry-After", "")
+                if retry_after.isascii() and retry_after.isdecimal():
+                    retry_hint = float(retry_after)
 
         except Exception as e:
             print(f"{RED}Client error: {e}{RESET}")
             raise
 
-        choice = input("Reconnect? [y/N]: ").strip().lower()
+        connected_at, attempts["connected_at"] = attempts["connected_at"], None
 
-        try:
-            if not str_to_bool(choice):
-                break
-        except ValueError:
+        if quitting:
             break
 
+        if nick_rejected:
+            attempt = 0
+            continue
+
+        if not AUTO_RECONNECT:
+            choice = input("Reconnect? [y/N]: ").strip().lower()
+            try:
+                if not str_to_bool(choice):
+                    break
+            except ValueError:
+                break
+            continue
+
+        if connected_at is not None and time.monotonic() - connected_at >= RECONNECT_RESET:
+            attempt = 0
+
+        if retry_hint is not None:
+            delay = retry_hint + random.uniform(0, 1)
+            retry_hint = None
+        else:
+            delay = backoff(attempt)
+            attempt += 1
+
+        print(colourise(f"LOCALSYS Reconnecting in {delay:.1f}s (attempt {attempt or 1})"))
+        await asyncio.sleep(delay)
+
 
 # ---------- entry ----------
 
@@ -0,0 +1,105 @@
+import argparse
+import importlib.util
+import os
+import sys
+from collections import deque
+
+# usage: python wirechat-logs.py <day> [kind] [--since TIME|SEQ] [--grep TEXT] [--tail N]
+#
+# Reads a day's log whether it is still plain text or already archived;
+# archived days are decompressed only from the member --since points at.
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "wirechat-server.py")
+
+
+def load_server():
+    spec = importlib.util.spec_from_file_location("wirechat_server", SERVER_PATH)
+    server = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(server)
+    return server
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Tail and search wirechat logs, plain or archived.")
+    p.add_argument("day", help="YYYY-MM-DD")
+    p.add_argument("kind", nargs="?", default="messages",
+                   help="messages, messages-<room>, connections, errors, server (default messages)")
+    p.add_argument("--since", help="HH:MM[:SS], an ISO timestamp, or a message seq")
+    p.add_argument("--grep", help="only lines containing this (case-insensitive)")
+    p.add_argument("--tail", type=int, help="only the last N lines")
+    return p.parse_args()
+
+
+def since_point(args):
+    """(line_keys() position, value) for --since."""
+    if args.since.isdigit():
+        return 0, int(args.since)
+    if args.kind.startswith("messages"):
+        return 1, args.since if "T" in args.since else f"{args.day}T{args.since}"
+    return 1, args.since.replace(":", ".")
+
+
+def archive_tail(index, count):
+    # decompress from the last member back until there are enough lines
+    for start in reversed(index.offsets or [0]):
+        lines = [line for line in index.lines(start) if line.strip()]
+        if len(lines) >= count or start == (index.offsets or [0])[0]:
+            return lines[-count:]
+    return []
+
+
+def after_point(server, lines, position, value):
+    started = False
+    for line in lines:
+        if not started:
+            keys = server.line_keys(line)
+            started = keys is not None and keys[position] >= value
+        if started:
+            yield line
+
+
+def main():
+    args = parse_args()
+    server = load_server()
+    path = os.path.join(server.LOG_DIR, f"{args.day}-{args.kind}.txt")
+
+    archived = not os.path.exists(path)
+    if archived:
+        path += ".gz"
+        if not os.path.exists(path):
+            print(f"no log for {args.day}-{args.kind}", file=sys.stderr)
+            return 1
+        index = server.ArchiveIndex(path)
+
+    if args.tail and not args.since and not args.grep:
+        if archived:
+            lines = archive_tail(index, args.tail)
+        else:
+            lines = [line.encode("utf-8") for line in server.read_tail_lines(path, args.tail)]
+    else:
+        if archived:
+            start = 0
+            if args.since:
+                position, value = since_point(args)
+                start = index.offset(("seq", "timestamp")[position], value)
+            lines = index.lines(start)
+        else:
+            lines = open(path, "rb")
+
+        if args.since:
+            lines = after_point(server, lines, *since_point(args))
+        if args.grep:
+            needle = args.grep.lower()
+            lines = (line for line in lines if needle in line.decode("utf-8", errors="replace").lower())
+        if args.tail:
+            lines = deque(lines, maxlen=args.tail)
+
+    for line in lines:
+        text = line.decode("utf-8", errors="replace").rstrip("\r\n")
+        if text:
+            print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,29 @@
 import asyncio
 import websockets
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 import signal
+import socket
 import os
+import sys
+import json
+import hashlib
+import gzip
 import time
+import random
 import re
+import inspect
+import bisect
+import queue
+import threading
+import itertools
+import traceback
+import cProfile
+import pstats
+import concurrent.futures
+from collections import OrderedDict, deque
+from http import HTTPStatus
 from websockets import ConnectionClosed
+from websockets.asyncio.server import ServerConnection
 
 # ---------- graceful shutdown ----------
 
@@ -25,91 +43,362 @@ def request_shutdown():
 # ---------- config ----------
 
 SERVER_START_TIME = time.monotonic()
+STARTUP_BEGAN = time.perf_counter()  # for the "ready in" of SERVER_START (uptime survives a takeover, this does not)
 HOST = "127.0.0.1"
-PORT = 12345
+PORT = int(os.environ.get("WIRECHAT_PORT", "12345"))
 MAX_MSG_LEN = 2048
 HISTORY_LINES = 50
+REPLAY_MAX = 1000               # most messages one REPLAY SINCE sends (the newest ones win)
+REPLAY_MAX_DAYS = 7             # how many days of log files REPLAY SINCE looks through
 VERSION = "1.2.1" #* MAJOR.MINOR.PATCH
+
+# outbound queues (see ---------- fan-out ----------)
+OUTBOX_LIMIT = 256              # frames queued per client before OUTBOX_POLICY kicks in
+OUTBOX_POLICY = "drop_oldest"   # drop_oldest | disconnect | lag
+OUTBOX_LAG_RESUME = 32          # a lagging client resumes once its queue drains to this
+
+# frame coalescing, for clients that sent CAPS batch (see ---------- fan-out ----------)
+CAPABILITIES = ("batch", "seq")  # advertised after the protocol line
+BATCH_MAX_BYTES = 16384         # queued lines are packed into one frame up to this size
+BATCH_WINDOW = 0                # seconds a lone line waits for company, 0 = only pack what is already queued
+
+# background log writer (see ---------- logging ----------)
+LOG_FLUSH_LINES = 200           # flush once this many lines are buffered
+LOG_FLUSH_INTERVAL = 0.25       # ... or once the oldest unflushed line is this old (seconds)
+LOG_FSYNC = False               # also fsync on every flush
+
+# log archive (see ---------- archive ----------)
+ARCHIVE_INTERVAL = 3600         # seconds between archiver runs, 0 disables it
+ARCHIVE_CHUNK = 65536           # uncompressed bytes per gzip member, the unit the index points at
+ARCHIVE_KEEP_DAYS = 90          # delete logs (archived or not) older than this, 0 keeps everything
+ARCHIVE_WORKERS = 2             # files compressed in parallel
+ARCHIVE_SETTLE = 300            # leave files alone that were written in the last N seconds
+
+# metrics (see ---------- metrics ----------)
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = int(os.environ.get("WIRECHAT_METRICS_PORT", "12346"))  # Prometheus text on /metrics, 0 to disable
+RATE_WINDOW = 10                # seconds averaged for the per-second rates in STATS
+
+# inbound rate limits (see ---------- rate limiting ----------)
+RATE_MSG = (5, 10)              # per connection, MSG: (tokens per second, burst)
+RATE_IMG = (0.5, 3)             # ... IMG
+RATE_CMD = (2, 10)              # ... every other command
+RATE_GLOBAL = (2000, 4000)      # all MSG/IMG on the server, split evenly between workers
+RATE_POLICY = "delay"           # delay | err | disconnect
+RATE_LOG_INTERVAL = 10          # seconds between THROTTLED log lines per client
+
+# admission control (see ---------- admission ----------)
+HANDSHAKE_TIMEOUT = 10          # seconds from TCP connect to NICK, else the connection is dropped
+MAX_CONNECTIONS = 10000         # open connections (joined or not) on the server, split evenly between workers
+MAX_PER_IP = 20                 # ... from one address, per process
+MAX_UPGRADING = 1000            # accepted sockets still before the WebSocket upgrade, per process; more are dropped
+FULL_RETRY = (5, 30)            # a refused client is told to come back after a random delay in this range
+IDLE_TIMEOUT = 3600             # seconds without a frame from a joined client before it is dropped, 0 = never
+IDLE_CHECK_INTERVAL = 60        # seconds between idle sweeps
+MAX_FRAME_BYTES = 65536         # bigger inbound frames are refused by websockets itself (close 1009)
+TRUSTED_PROXIES = ("127.0.0.1", "::1")  # peers whose X-Real-IP / X-Forwarded-For is believed
+
+# moderation
+MODERATION_CACHE_SIZE = 4096    # verdicts remembered per exact text (LRU), 0 disables
+DUPLICATE_WINDOW = 0            # seconds a nick may not repeat the same MSG/IMG, 0 = off
+DUPLICATE_TRACK = 16            # recent lines remembered per client for that
+
+# rooms (see ---------- rooms ----------)
+DEFAULT_ROOM = "lobby"          # everyone starts here; logs to the plain messages file
+MAX_ROOMS = 100                 # rooms with at least one member, DEFAULT_ROOM included
+PRESENCE_WINDOW = 2.0           # seconds join/leave notices are collected for once a room gets busy
+PRESENCE_QUIET = 3              # notices per window still sent one by one, 0 = always summarise
+PRESENCE_NAMES = 10             # names listed in a summary line, the rest are only counted
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 LOG_DIR = os.path.join(BASE_DIR, "logs")
 CONFIG_PATH = os.path.join(BASE_DIR, "config")
 
-ADMIN_TOKEN = None
-# 1) try environment first (production)
-if "WIRECHAT_ADMIN_TOKEN" in os.environ:
-    ADMIN_TOKEN = os.environ["WIRECHAT_ADMIN_TOKEN"]
+# multi-process mode (see ---------- cluster ----------)
+WORKERS = int(os.environ.get("WIRECHAT_WORKERS", "1"))  # >1: supervisor + N workers sharing PORT
+WORKER_ID = os.environ.get("WIRECHAT_WORKER_ID")         # set by the supervisor, never by hand
+BUS_PATH = os.path.join(BASE_DIR, ".bus.sock")
+
+# zero-downtime restarts (see ---------- handoff ----------)
+TAKEOVER = os.environ.get("WIRECHAT_TAKEOVER") == "1"  # take port and state over from the running server
+HANDOFF_PATH = os.path.join(BASE_DIR, ".handoff.sock")
+HANDOFF_TIMEOUT = 10            # seconds the new process gets to start serving
+HANDOFF_DRAIN = 60              # seconds the old one keeps serving its clients after that
+RESTART_RETRY = (1, 10)         # restart: each client is told to come back after a random delay in this range
+SHUTDOWN_RETRY = 60             # shutdown: ... after this long
+
+# profiling (see ---------- profiling ----------)
+PROFILE_MAX_SECONDS = 300       # a profile stops and is written out by itself after this long
+PROFILE_TOP = 40                # functions listed in the text report
+LOOP_LAG_INTERVAL = 0.1         # seconds between event-loop lag probes, 0 disables the monitor
+LOOP_LAG_THRESHOLD = 0.1        # a probe this late (seconds) is logged, with what the loop was doing
+
+# moderation matcher cache (see build_matcher)
+MATCHER_VERSION = 1             # bump whenever build_matcher() output changes; invalidates the cache
+MATCHER_CACHE = os.path.join(BASE_DIR, ".matcher-cache.json")
+
+# hot reload (see ---------- reload ----------)
+CONFIG_WATCH_INTERVAL = 2       # seconds between config file mtime checks, 0 disables
+
+def rate_limit(value):
+    # "5/10": 5 tokens per second, bursts of up to 10
+    rate, sep, burst = value.partition("/")
+    limit = (float(rate), float(burst or rate))
+    if limit[0] <= 0 or limit[1] < 1:
+        raise ValueError(f"rate limit {value!r}: the rate must be positive and the burst at least 1")
+    return limit
+
+
+# settings config/server.txt may override, re-read on every reload
+SETTINGS = {
+    "MAX_MSG_LEN": int,
+    "HISTORY_LINES": int,
+    "REPLAY_MAX": int,
+    "RATE_POLICY": str,
+    "RATE_MSG": rate_limit,
+    "RATE_IMG": rate_limit,
+    "RATE_CMD": rate_limit,
+    "RATE_GLOBAL": rate_limit,
+    "DUPLICATE_WINDOW": float,
+}
+SETTING_DEFAULTS = {name: globals()[name] for name in SETTINGS}
+RATE_POLICIES = ("delay", "err", "disconnect")
+
+
+def load_settings():
+    """SETTING_DEFAULTS with the KEY=VALUE lines of config/server.txt applied."""
+    settings = dict(SETTING_DEFAULTS)
+    try:
+        with open(os.path.join(CONFIG_PATH, "server.txt"), "r", encoding="utf-8") as f:
+            for number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+
+                name, sep, value = line.partition("=")
+                name = name.strip()
+                if not sep or name not in SETTINGS:
+                    raise ValueError(f"server.txt line {number}: unknown setting {name!r}")
+                settings[name] = SETTINGS[name](value.strip())
+    except FileNotFoundError:
+        pass
+
+    if settings["MAX_MSG_LEN"] < 1 or settings["HISTORY_LINES"] < 1 or settings["REPLAY_MAX"] < 1:
+        raise ValueError("server.txt: MAX_MSG_LEN, HISTORY_LINES and REPLAY_MAX must be positive")
+    if settings["RATE_POLICY"] not in RATE_POLICIES:
+        raise ValueError(f"server.txt: RATE_POLICY must be one of {', '.join(RATE_POLICIES)}")
+    return settings
+
 
-# 2) fallback to local config (dev)
-else:
+def load_admin_token():
+    # 1) try environment first (production)
+    if "WIRECHAT_ADMIN_TOKEN" in os.environ:
+        return os.environ["WIRECHAT_ADMIN_TOKEN"]
+
+    # 2) fallback to local config (dev)
+    token = None
     try:
         with open(os.path.join(CONFIG_PATH, "secrets.txt"), "r", encoding="utf-8") as f:
             for line in f:
                 if line.startswith("ADMIN_TOKEN="):
-                    ADMIN_TOKEN = line.strip().split("=",1)[1]
+                    token = line.strip().split("=",1)[1]
     except FileNotFoundError:
         pass
+    return token
+
 
+globals().update(load_settings())
+
+ADMIN_TOKEN = load_admin_token()
 if not ADMIN_TOKEN:
     raise RuntimeError("ADMIN_TOKEN not set")
 
-def load_forbidden():
+def parse_forbidden(text):
     words = []
-    with open(os.path.join(CONFIG_PATH,"forbidden.txt"), "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip().lower()
-            if line:
-                words.append(line)
+    for line in text.splitlines():
+        line = line.strip().lower()
+        if line:
+            words.append(line)
     return words
 
-FORBIDDEN = load_forbidden()
-FORBIDDEN_PATTERNS = []
+def load_forbidden():
+    with open(os.path.join(CONFIG_PATH,"forbidden.txt"), "r", encoding="utf-8") as f:
+        return parse_forbidden(f.read())
+
+def build_trie(words):
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = True
+    return trie
+
+
+def trie_regex(node):
+    # turns a character trie into one regex where shared prefixes are only
+    # tried once, e.g. ["anal", "anus"] -> an(?:al|us)
+    if "" in node and len(node) == 1:
+        return None
+
+    alternatives = []
+    singles = []
+    optional = False
+
+    for ch in sorted(node):
+        if ch == "":
+            optional = True
+            continue
+
+        rest = trie_regex(node[ch])
+        if rest is None:
+            singles.append(re.escape(ch))
+        else:
+            alternatives.append(re.escape(ch) + rest)
+
+    only_singles = not alternatives
+
+    if singles:
+        alternatives.append(singles[0] if len(singles) == 1 else "[" + "".join(singles) + "]")
+
+    if len(alternatives) == 1:
+        result = alternatives[0]
+    else:
+        result = "(?:" + "|".join(alternatives) + ")"
 
-for word in FORBIDDEN:
-    escaped = re.escape(word)
+    if optional:
+        if only_singles and len(singles) == 1:
+            return result + "?"
+        return "(?:" + result + ")?"
 
-    if " " in word:
-        # normal phrase (with spaces)
-        FORBIDDEN_PATTERNS.append(
-            re.compile(escaped, re.IGNORECASE)
-        )
+    return result
 
-        # merged phrase (no spaces)
-        merged = re.escape(word.replace(" ", ""))
-        FORBIDDEN_PATTERNS.append(
-            re.compile(merged, re.IGNORECASE)
-        )
 
-    else:
-        # single word with boundaries
-        FORBIDDEN_PATTERNS.append(
-            re.compile(rf"\b{escaped}\b", re.IGNORECASE)
-        )
+def build_matcher(words):
+    """Compile the forbidden list into a single regex.
 
-clients = {}  # websocket -> nickname
-admins = set()
-kicked = set()
+    Single words keep their word boundaries, phrases match both with
+    spaces and merged (same rules as the old one-pattern-per-entry loop).
+    """
+    singles = set()
+    phrases = set()
 
-os.makedirs(LOG_DIR, exist_ok=True)
+    for word in words:
+        if " " in word:
+            phrases.add(word)
+            phrases.add(word.replace(" ", ""))
+        else:
+            singles.add(word)
 
-COMMAND_HELP = {
-    "WHO":  "List connected users",
-    "VERSION": "Get server and client version",
-    "CMDS": "Show available commands",
-    "HELP": "An alias of CMDS",
-    "QUIT": "Disconnect from the server",
-    "PING": "A simple PING PONG command",
-    "UPTIME": "Get uptime",
-    "STATS": "Get server stats",
-    "ADMIN": "Enter admin token",
-    "IMG": "Sends an image"
-}
+    branches = []
+    if singles:
+        branches.append(r"\b" + "(?:" + trie_regex(build_trie(singles)) + r")\b")
+    if phrases:
+        branches.append("(?:" + trie_regex(build_trie(phrases)) + ")")
+
+    if not branches:
+        return re.compile(r"(?!)")  # nothing is forbidden
+
+    # no IGNORECASE: normalise() already lowercases, and the flag makes
+    # the search several times slower
+    return re.compile("|".join(branches))
+
+
+def read_matcher_cache(digest):
+    try:
+        with open(MATCHER_CACHE, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return cached.get("pattern") if cached.get("digest") == digest else None
 
-COMMAND_ADMIN = {
-    "KICK": "Kick a user by nickname"
-}
+
+def write_matcher_cache(digest, pattern):
+    tmp = f"{MATCHER_CACHE}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"digest": digest, "pattern": pattern}, f)
+        os.replace(tmp, MATCHER_CACHE)
+    except OSError:
+        pass  # read-only checkout: build every time
+
+
+class Matcher:
+    """build_matcher() for one forbidden list, cached on disk.
+
+    Compiled patterns cannot be serialised, so MATCHER_CACHE keeps the
+    regex source under a hash of forbidden.txt and MATCHER_VERSION. With a
+    matching hash the trie is not built at all and the cached source is
+    compiled right away, at load time. Otherwise building it is left to
+    compile(), which main() runs off the event loop once the server is up;
+    it writes the cache for the next start (and for the other workers).
+    """
+
+    def __init__(self, words, digest):
+        self.words = words
+        self.digest = digest
+        self.lock = threading.Lock()  # one build, even if a check comes in during it
+        self.pattern = read_matcher_cache(digest)
+        if self.pattern is not None:
+            self.source = "cached"
+            self.regex = re.compile(self.pattern)
+        else:
+            self.source = "stale"
+            self.regex = None
+
+    def compile(self):
+        if self.regex is None:
+            with self.lock:
+                if self.regex is None:
+                    regex = build_matcher(self.words)
+                    self.pattern = regex.pattern
+                    self.source = "built"
+                    write_matcher_cache(self.digest, self.pattern)
+                    self.regex = regex
+        return self.regex
+
+    def search(self, text):
+        # only builds if a check comes in before main()'s background build is done
+        return self.compile().search(text)
+
+
+def load_matcher():
+    """forbidden.txt as (words, Matcher)."""
+    with open(os.path.join(CONFIG_PATH, "forbidden.txt"), "rb") as f:
+        data = f.read()
+    digest = hashlib.sha256(f"{MATCHER_VERSION}\n".encode() + data).hexdigest()
+    words = parse_forbidden(data.decode("utf-8"))
+    return words, Matcher(words, digest)
+
+
+FORBIDDEN, FORBIDDEN_MATCHER = load_matcher()
+
+os.makedirs(LOG_DIR, exist_ok=True)
 
 stats = {
-    "messages_session": 0
+    "messages_session": 0,
+    "frames_in": 0,         # frames received from joined clients
+    "frames_out": 0,        # frames written to clients
+    "outbox_peak": 0,       # deepest any outbound queue has been
+    "outbox_dropped": 0,    # frames discarded by drop_oldest / lag
+    "outbox_lagging": 0,    # times a client was marked as lagging
+    "outbox_evictions": 0,  # clients disconnected for being too slow
+    "batch_frames": 0,      # frames that carried more than one line (CAPS batch)
+    "batch_lines": 0,       # lines sent in those frames
+    "moderation_hits": 0,   # contains_forbidden() answered from the verdict cache
+    "moderation_misses": 0,
+    "duplicates": 0,        # MSG/IMG refused as repeats within DUPLICATE_WINDOW
+    "reloads": 0,           # successful config reloads
+    "reload_seconds": 0.0,  # how long the last one took
+    "archived_files": 0,    # day logs compressed by the archiver
+    "refused_full": 0,      # connections turned away at MAX_CONNECTIONS
+    "refused_ip": 0,        # ... at MAX_PER_IP
+    "refused_upgrading": 0,  # sockets dropped on accept at MAX_UPGRADING
+    "handshake_timeouts": 0,  # connections that did not send NICK within HANDSHAKE_TIMEOUT
+    "idle_reaped": 0,       # joined clients dropped after IDLE_TIMEOUT
+    "loop_stalls": 0,       # lag probes later than LOOP_LAG_THRESHOLD
+    "loop_lag_worst": 0.0,  # the latest any probe has been (seconds)
+    "presence_coalesced": 0,  # join/leave notices folded into a summary line
 }
 
 RESTART_FLAG = os.path.join(BASE_DIR, ".restart")
@@ -119,10 +408,134 @@ def is_restart():
 
 # ---------- logging ----------
 
+class LogWriter:
+    """Appends log lines from a background thread.
+
+    The event loop only enqueues. The thread collects lines per file until
+    LOG_FLUSH_LINES / LOG_FLUSH_INTERVAL say it is time, then appends each
+    file's batch with a single write (plus fsync with LOG_FSYNC). One write
+    per batch also means worker processes sharing a log file never
+    interleave half lines.
+    """
+
+    STOP = object()
+
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.files = {}  # path -> open file, today's only
+        self.thread = None
+        self.lock = threading.Lock()
+        self.errors = 0
+
+    def write(self, path, text):
+        if self.thread is None:
+            self.start()
+        self.queue.put((path, text))
+
+    def backlog(self):
+        return self.queue.qsize()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+                self.thread.start()
+
+    def sync(self, timeout=5):
+        """Block until everything queued so far is written and flushed."""
+        if self.thread is None:
+            return True
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout=5):
+        if self.thread is None:
+            return
+        self.queue.put(self.STOP)
+        self.thread.join(timeout)
+
+    def handle(self, path):
+        f = self.files.get(path)
+        if f is None:
+            # a new day started: yesterday's files are finished
+            day = os.path.basename(path)[:10]
+            for old in [p for p in self.files if os.path.basename(p)[:10] != day]:
+                self.files.pop(old).close()
+
+            f = self.files[path] = open(path, "ab", buffering=0)
+        return f
+
+    def flush(self, pending):
+        for path, texts in pending.items():
+            try:
+                f = self.handle(path)
+                f.write("".join(texts).encode("utf-8"))
+                if LOG_FSYNC:
+                    os.fsync(f.fileno())
+            except Exception:
+                self.errors += 1
+        pending.clear()
+
+    def run(self):
+        pending = {}  # path -> [text]
+        unflushed = 0
+        last_flush = time.monotonic()
+
+        while True:
+            timeout = None
+            if unflushed:
+                timeout = max(0, LOG_FLUSH_INTERVAL - (time.monotonic() - last_flush))
+
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            waiters = []
+            stop = False
+
+            # take everything that is already waiting
+            while item is not None:
+                if item is self.STOP:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    path, text = item
+                    pending.setdefault(path, []).append(text)
+                    unflushed += 1
+
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    item = None
+
+            now = time.monotonic()
+            if unflushed and (
+                stop or waiters
+                or unflushed >= LOG_FLUSH_LINES
+                or now - last_flush >= LOG_FLUSH_INTERVAL
+            ):
+                self.flush(pending)
+                unflushed = 0
+                last_flush = now
+
+            for waiter in waiters:
+                waiter.set()
+
+            if stop:
+                for f in self.files.values():
+                    f.close()
+                self.files.clear()
+                return
+
+
+log_writer = LogWriter()
+
 def log_line(filename, message):
     t = datetime.now().strftime("%H.%M.%S")
-    with open(filename, "a", encoding="utf-8") as f:
-        f.write(f"\n{t}: {message}")
+    log_writer.write(filename, f"\n{t}: {message}")
 
 def log_safe(filename, message):
     try:
@@ -130,13 +543,12 @@ def log_safe(filename, message):
     except Exception:
         pass
 
-def log_file(kind):
-    today = date.today().isoformat()
-    return f"{LOG_DIR}/{today}-{kind}.txt"
+def log_file(kind, day=None):
+    day = day or date.today().isoformat()
+    return f"{LOG_DIR}/{day}-{kind}.txt"
 
 def persist_message(filename, message):
-    with open(filename, "a", encoding="utf-8") as f:
-        f.write(message + "\n")
+    log_writer.write(filename, message + "\n")
 
 # ---------- helpers ----------
 
@@ -147,30 +559,1085 @@ def valid_nickname(nick):
         and " " not in nick
     )
 
-async def broadcast(message):
-    dead = []
-    for ws in list(clients):
+ROOM_RE = re.compile(r"[a-z0-9_-]{1,20}")
+
+def valid_room(name):
+    return ROOM_RE.fullmatch(name) is not None
+
+# ---------- fan-out ----------
+
+_send_text_bytes = {}
+
+def send_accepts_text(ws):
+    # websockets >= 14 can send pre-encoded bytes as a text frame
+    cls = type(ws)
+    if cls not in _send_text_bytes:
+        try:
+            params = inspect.signature(cls.send).parameters
+            _send_text_bytes[cls] = "text" in params
+        except (TypeError, ValueError):
+            _send_text_bytes[cls] = False
+    return _send_text_bytes[cls]
+
+
+class Frame:
+    """One outbound line, encoded at most once no matter how many clients get it."""
+
+    __slots__ = ("text", "_data", "_line", "created")
+
+    def __init__(self, text, created=None):
+        self.text = text
+        self._data = None
+        self._line = None
+        self.created = created  # set for broadcasts, to measure fan-out latency
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self.text.encode("utf-8")
+        return self._data
+
+    @property
+    def line(self):
+        # what batch clients get: newlines separate lines there, so a
+        # message that contains one is flattened
+        if self._line is None:
+            data = self.data
+            if b"\n" in data:
+                data = data.replace(b"\r\n", b" ").replace(b"\n", b" ")
+            self._line = data
+        return self._line
+
+
+class Outbox:
+    """Bounded per-client send queue drained by its own writer task."""
+
+    __slots__ = (
+        "ws", "name", "batch", "queue", "wakeup", "drain", "encoded",
+        "lagging", "skipped", "closed", "closer", "task",
+    )
+
+    def __init__(self, ws, name, batch=False):
+        self.ws = ws
+        self.name = name
+        self.batch = batch  # pack queued lines into newline-separated frames
+        self.queue = deque()
+        # bare futures rather than asyncio.Events: an Event carries its own
+        # waiter deque, and every idle client would hold two of them
+        self.wakeup = None  # the idle writer waits on this
+        self.drain = None   # close() waits on this until the queue is empty
+        self.encoded = send_accepts_text(ws)
+        self.lagging = False
+        self.skipped = 0
+        self.closed = False
+        self.closer = None
+        self.task = asyncio.create_task(self.run())
+
+    def put(self, frame):
+        if self.closed:
+            return False
+
+        if self.lagging:
+            self.skipped += 1
+            stats["outbox_dropped"] += 1
+            return False
+
+        if len(self.queue) >= OUTBOX_LIMIT:
+            if OUTBOX_POLICY == "disconnect":
+                self.evict()
+                return False
+
+            if OUTBOX_POLICY == "lag":
+                self.lagging = True
+                self.skipped += 1
+                stats["outbox_lagging"] += 1
+                stats["outbox_dropped"] += 1
+                log_safe(log_file("errors"), f"OUTBOX_LAGGING {self.name}")
+                return False
+
+            # drop_oldest
+            self.queue.popleft()
+            stats["outbox_dropped"] += 1
+
+        self.queue.append(frame)
+        wakeup = self.wakeup
+        if wakeup is not None:
+            self.wakeup = None
+            if not wakeup.done():
+                wakeup.set_result(None)
+
+        if len(self.queue) > stats["outbox_peak"]:
+            stats["outbox_peak"] = len(self.queue)
+
+        return True
+
+    def send(self, text):
+        return self.put(Frame(text))
+
+    def drained(self):
+        drain, self.drain = self.drain, None
+        if drain is not None and not drain.done():
+            drain.set_result(None)
+
+    def evict(self):
+        self.closed = True
+        self.queue.clear()
+        self.drained()
+        stats["outbox_evictions"] += 1
+        log_safe(log_file("errors"), f"OUTBOX_EVICT {self.name}")
+        self.closer = asyncio.create_task(
+            self.ws.close(code=4001, reason="Too slow")
+        )
+
+    async def run(self):
         try:
-            await ws.send(message)
+            while True:
+                if not self.queue:
+                    self.drained()
+                    self.wakeup = asyncio.get_running_loop().create_future()
+                    await self.wakeup
+                    continue
+
+                if self.batch:
+                    if BATCH_WINDOW and len(self.queue) == 1:
+                        await asyncio.sleep(BATCH_WINDOW)
+                        if not self.queue:
+                            continue
+                    frames = self.take_batch()
+                    await self.send_batch(frames)
+                else:
+                    frames = (self.queue.popleft(),)
+                    if self.encoded:
+                        await self.ws.send(frames[0].data, text=True)
+                    else:
+                        await self.ws.send(frames[0].text)
+
+                stats["frames_out"] += len(frames)
+                now = time.perf_counter()
+                for frame in frames:
+                    if frame.created is not None:
+                        FANOUT_LATENCY.observe(now - frame.created)
+
+                if self.lagging and len(self.queue) <= OUTBOX_LAG_RESUME:
+                    self.lagging = False
+                    self.queue.append(Frame(
+                        f"SYS You fell behind, {self.skipped} messages were skipped"
+                    ))
+                    self.skipped = 0
+
+        except ConnectionClosed:
+            pass
+
         except Exception as e:
-            dead.append(ws)
-            log_safe(log_file("errors"), f"BROADCAST_FAIL {clients.get(ws)} {e}")
+            log_safe(log_file("errors"), f"BROADCAST_FAIL {self.name} {e}")
+
+        finally:
+            self.closed = True
+            self.queue.clear()
+            self.drained()
+
+    def take_batch(self):
+        frames = [self.queue.popleft()]
+        size = len(frames[0].line)
+
+        while self.queue and size + 1 + len(self.queue[0].line) <= BATCH_MAX_BYTES:
+            frame = self.queue.popleft()
+            frames.append(frame)
+            size += 1 + len(frame.line)
+
+        return frames
+
+    async def send_batch(self, frames):
+        data = b"\n".join(frame.line for frame in frames)
+        if len(frames) > 1:
+            stats["batch_frames"] += 1
+            stats["batch_lines"] += len(frames)
+
+        if self.encoded:
+            await self.ws.send(data, text=True)
+        else:
+            await self.ws.send(data.decode("utf-8"))
+
+    async def close(self, code=1000, reason="", timeout=2):
+        # give queued frames (e.g. a final ERR) a chance to go out first
+        if self.queue and not self.closed:
+            if self.drain is None:
+                self.drain = asyncio.get_running_loop().create_future()
+            try:
+                await asyncio.wait_for(asyncio.shield(self.drain), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        self.closed = True
+
+        try:
+            await asyncio.wait_for(self.ws.close(code=code, reason=reason), timeout=timeout)
+        except Exception:
+            pass
+
+    def stop(self):
+        self.closed = True
+        self.queue.clear()
+        self.task.cancel()
+
+
+def broadcast_local(message, room=None, skip=()):
+    # room=None is everyone (server notices), otherwise only that room's
+    # members; nicknames in `skip` do not get it
+    frame = Frame(message, time.perf_counter())
+    members = sessions.by_ws if room is None else room.members
+    if skip:
+        for session in members.values():
+            if session.nickname not in skip:
+                session.outbox.put(frame)
+        return
 
-    for ws in dead:
-        clients.pop(ws, None)
+    for session in members.values():
+        session.outbox.put(frame)
 
-def load_recent_messages():
-    today = date.today().isoformat()
-    path = f"{LOG_DIR}/{today}-messages.txt"
+
+def broadcast(message, room=None, skip=()):
+    broadcast_local(message, room, skip)
+    link = bus or predecessor
+    if link:
+        op = {"op": "frame", "room": room and room.name, "text": message}
+        if skip:
+            op["skip"] = list(skip)
+        link.send(op)
+
+
+def outbox_depths():
+    depths = [len(s.outbox.queue) for s in sessions.by_ws.values()]
+    return sum(depths), max(depths, default=0)
+
+# ---------- sessions ----------
+
+NO_CAPS = frozenset()  # shared by every client that did not send CAPS
+
+
+class Session:
+    """State for one joined connection.
+
+    Everything the server keeps per client is here (plus its Outbox), in
+    slots: with tens of thousands of mostly idle clients, per-instance
+    dicts and containers that stay empty add up. Rate-limit buckets and
+    the duplicate tracker are only created once the client sends something
+    that needs them.
+    """
+
+    __slots__ = (
+        "ws", "nickname", "admin", "kicked", "outbox", "room", "caps",
+        "joined", "last_active", "frames", "messages",
+        "buckets", "throttled", "throttle_logged", "recent",
+    )
+
+    def __init__(self, ws, nickname):
+        self.ws = ws
+        self.nickname = nickname
+        self.admin = False
+        self.kicked = False
+        self.outbox = None
+        self.room = None
+        self.caps = NO_CAPS
+        self.joined = time.monotonic()
+        self.last_active = self.joined  # last frame received, for the idle reaper
+        self.frames = 0               # frames received
+        self.messages = 0             # MSG/IMG published
+        self.buckets = {}             # rate-limit bucket name -> TokenBucket, on first use
+        self.throttled = 0            # throttled frames not yet logged
+        self.throttle_logged = None   # monotonic time of the last THROTTLED line
+        self.recent = None            # text -> monotonic time sent, oldest first (OrderedDict)
+
+
+class Registry:
+    """Joined sessions, indexed by websocket and by case-folded nickname.
+
+    Every method is synchronous, so a check-and-insert can never interleave
+    with another join or a kick on the event loop. In multi-process mode it
+    also mirrors the nicknames joined on other workers, so WHO and the
+    user count cover the whole cluster.
+    """
+
+    def __init__(self):
+        self.by_ws = {}
+        self.by_nick = {}
+        self.remote = {}  # case-folded nickname -> nickname, other workers
+        self.names = []  # sorted, local and remote, kept up to date on join/leave
+        self._who = None
+
+    def __len__(self):
+        return len(self.by_ws)
+
+    def get(self, ws):
+        return self.by_ws.get(ws)
+
+    def find(self, nickname):
+        return self.by_nick.get(nickname.casefold())
+
+    def find_remote(self, nickname):
+        return self.remote.get(nickname.casefold())
+
+    def add(self, session):
+        key = session.nickname.casefold()
+        if key in self.by_nick or key in self.remote:
+            return False
+
+        self.by_ws[session.ws] = session
+        self.by_nick[key] = session
+        bisect.insort(self.names, session.nickname)
+        self._who = None
+        return True
+
+    def remove(self, ws):
+        session = self.by_ws.pop(ws, None)
+        if session is None:
+            return None
+
+        self.by_nick.pop(session.nickname.casefold(), None)
+        self._forget(session.nickname)
+        return session
+
+    def add_remote(self, nickname):
+        key = nickname.casefold()
+        if key in self.by_nick or key in self.remote:
+            return
+        self.remote[key] = nickname
+        bisect.insort(self.names, nickname)
+        self._who = None
+
+    def remove_remote(self, nickname):
+        if self.remote.pop(nickname.casefold(), None) is not None:
+            self._forget(nickname)
+
+    def _forget(self, nickname):
+        i = bisect.bisect_left(self.names, nickname)
+        if i < len(self.names) and self.names[i] == nickname:
+            del self.names[i]
+        self._who = None
+
+    def who(self):
+        if self._who is None:
+            self._who = f"SYS Online ({len(self.names)}): " + ", ".join(self.names)
+        return self._who
+
+
+sessions = Registry()
+
+# ---------- replay ----------
+
+# lines written before sequence numbers existed have no "#<seq> " prefix
+RECORD_RE = re.compile(r"^(?:#(\d+) )?\[([^\]]*)\] (\S+): (.*)$")
+
+
+class Record:
+    """A persisted MSG/IMG line, parsed once and rendered on demand."""
+
+    __slots__ = ("kind", "timestamp", "sender", "body", "seq")
+
+    def __init__(self, kind, timestamp, sender, body, seq=None):
+        self.kind = kind
+        self.timestamp = timestamp
+        self.sender = sender
+        self.body = body
+        self.seq = seq  # assigned where the record is persisted
+
+    def frame(self, numbered=False):
+        # numbered: for sessions with CAPS seq, "MSG <seq> [...] ..."
+        prefix = f"{self.kind} {self.seq} " if numbered and self.seq is not None else f"{self.kind} "
+        if self.kind == "IMG":
+            return f"{prefix}[{self.timestamp}] {self.sender} {self.body}"
+        return f"{prefix}[{self.timestamp}] {self.sender}: {self.body}"
+
+    def pack(self):
+        return [self.kind, self.timestamp, self.sender, self.body, self.seq]
+
+    def log_line(self):
+        prefix = f"#{self.seq} " if self.seq is not None else ""
+        if self.kind == "IMG":
+            return f"{prefix}[{self.timestamp}] {self.sender}: [IMG] {self.body}"
+        return f"{prefix}[{self.timestamp}] {self.sender}: {self.body}"
+
+
+def parse_record(line):
+    # inverse of Record.log_line()
+    match = RECORD_RE.match(line.strip())
+    if not match:
+        return None
+
+    seq, timestamp, sender, body = match.groups()
+    seq = int(seq) if seq else None
+    if body.startswith("[IMG] "):
+        return Record("IMG", timestamp, sender, body[6:], seq)
+    return Record("MSG", timestamp, sender, body, seq)
+
+
+def read_tail_lines(path, count, block=8192):
+    # walk backwards from EOF until we have enough lines, so warming up
+    # does not depend on how big today's log already is
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b""
+
+        while pos > 0 and data.count(b"\n") <= count:
+            step = min(block, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+
+    lines = data.decode("utf-8", errors="replace").splitlines()
+    if pos > 0:
+        lines = lines[1:]  # first line is probably cut in half
+    return lines[-count:] if count else []
+
+
+class ReplayBuffer:
+    """Last HISTORY_LINES records of the day, kept in memory for joins."""
+
+    def __init__(self, size):
+        self.records = deque(maxlen=size)
+
+    def resize(self, size):
+        # keeps the newest records; growing fills up with new messages only
+        if size != self.records.maxlen:
+            self.records = deque(self.records, maxlen=size)
+
+    def append(self, record):
+        self.records.append(record)
+
+    def recent(self):
+        # replay only ever covered today's log file
+        today = date.today().isoformat()
+        return [r for r in self.records if r.timestamp.startswith(today)]
+
+    def warm(self, path):
+        try:
+            lines = read_tail_lines(path, self.records.maxlen)
+        except FileNotFoundError:
+            return 0
+
+        for line in lines:
+            record = parse_record(line)
+            if record:
+                self.records.append(record)
+
+        return len(self.records)
+
+    def since(self, key, value):
+        """Records after `value`, or None if some of them may be older than the buffer."""
+        if not self.records or self.records[0].seq is None:
+            return None  # warmed from a log written before sequence numbers
+        if getattr(self.records[0], key) > value:
+            return None
+        return [r for r in self.records if getattr(r, key) > value]
+
+
+MESSAGE_LOG_RE = re.compile(r"^(\d{4}-\d{2}-\d{2})-messages(?:-[a-z0-9_-]+)?\.txt(?:\.gz)?$")
+
+
+def last_seq():
+    # the newest day's message logs end with the highest sequence numbers
+    days = {}
+    for name in os.listdir(LOG_DIR):
+        match = MESSAGE_LOG_RE.match(name)
+        if match:
+            days.setdefault(match.group(1), []).append(name)
+
+    if not days:
+        return 0
+
+    highest = 0
+    for name in days[max(days)]:
+        path = os.path.join(LOG_DIR, name)
+        if name.endswith(".gz"):
+            highest = max(highest, ArchiveIndex(path).last_seq)
+            continue
+        for line in read_tail_lines(path, 1):
+            record = parse_record(line)
+            if record and record.seq:
+                highest = max(highest, record.seq)
+    return highest
+
+
+sequence = None  # itertools.count, only where messages are persisted
+
+
+def start_sequence():
+    global sequence
+    sequence = itertools.count(last_seq() + 1)
+
+
+class LogIndex:
+    """Sparse seq / timestamp -> byte offset index of one message log.
+
+    Built by scanning the file on first use, then extended from where the
+    last scan stopped. Every STRIDE-th record is indexed; a lookup seeks
+    to the closest indexed record and reads forward from there. Runs in
+    worker threads, hence the lock.
+    """
+
+    STRIDE = 64
+
+    def __init__(self, path):
+        self.path = path
+        self.seq = []
+        self.timestamp = []
+        self.offsets = []
+        self.scanned = 0  # bytes indexed so far (always at a line start)
+        self.lines = 0
+        self.lock = threading.Lock()
+
+    def update(self):
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+
+        with f:
+            f.seek(self.scanned)
+            offset = self.scanned
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # still being written
+                if self.lines % self.STRIDE == 0:
+                    record = parse_record(line.decode("utf-8", errors="replace"))
+                    if record:
+                        self.seq.append(record.seq or 0)
+                        self.timestamp.append(record.timestamp)
+                        self.offsets.append(offset)
+                self.lines += 1
+                offset += len(line)
+            self.scanned = offset
+
+    def first(self, key):
+        with self.lock:
+            self.update()
+            keys = getattr(self, key)
+            return keys[0] if keys else None
+
+    def after(self, key, value, limit):
+        """(newest `limit` records after `value`, how many matched in total)"""
+        with self.lock:
+            self.update()
+            keys = getattr(self, key)
+            i = bisect.bisect_right(keys, value) - 1
+            start = self.offsets[i] if i >= 0 else 0
+            end = self.scanned
+
+        def lines():
+            pos = start
+            for line in f:
+                pos += len(line)
+                if pos > end:
+                    return
+                yield line
+
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            return records_after(lines(), key, value, limit)
+
+
+def records_after(lines, key, value, limit):
+    """(newest `limit` records after `value` among `lines`, how many matched in total)"""
+    found = deque(maxlen=limit)
+    total = 0
+    for line in lines:
+        record = parse_record(line.decode("utf-8", errors="replace"))
+        if record is None:
+            continue
+        point = (record.seq or 0) if key == "seq" else record.timestamp
+        if point > value:
+            found.append(record)
+            total += 1
+    return list(found), total
+
+
+log_indexes = {}  # path -> LogIndex or ArchiveIndex
+
+
+def read_since(room_name, key, value, limit):
+    """The last `limit` records of `room_name` after `value` (a seq or an ISO
+    timestamp), from the log files of the last REPLAY_MAX_DAYS days.
+    Blocking: run it in a thread.
+    """
+    today = date.today()
+    days = [(today - timedelta(days=n)).isoformat() for n in range(REPLAY_MAX_DAYS)]
+
+    for path in list(log_indexes):
+        if os.path.basename(path)[:10] < days[-1]:
+            log_indexes.pop(path, None)
+
+    # newest first, until the file the requested point falls in
+    wanted = []
+    for day in days:
+        path = room_log(room_name, day)
+        if not os.path.exists(path):
+            path += ".gz"
+            if not os.path.exists(path):
+                continue
+        if key == "timestamp" and day < value[:10]:
+            break
+        index = log_indexes.get(path)
+        if index is None:
+            index = log_indexes[path] = ArchiveIndex(path) if path.endswith(".gz") else LogIndex(path)
+        wanted.append(index)
+        first = index.first(key)
+        if first is not None and first <= value:
+            break
+
+    found = deque(maxlen=limit)
+    total = 0
+    for index in reversed(wanted):
+        records, count = index.after(key, value, limit)
+        found.extend(records)
+        total += count
+    return list(found), total
+
+
+# ---------- archive ----------
+#
+# Finished days are compressed in the background into <name>.txt.gz, a
+# series of gzip members of about ARCHIVE_CHUNK bytes each (together still
+# an ordinary .gz file), next to <name>.txt.gz.idx: a JSON list of where
+# each member starts and the seq and time of its first line. Readers seek
+# to the member before what they want and decompress from there on.
+
+LOG_NAME_RE = re.compile(r"^(\d{4}-\d{2}-\d{2})-[a-z0-9_-]+\.txt(?:\.gz(?:\.idx)?)?$")
+LOG_TIME_RE = re.compile(r"^(\d{2}\.\d{2}\.\d{2}): ")
+
+
+def line_keys(line):
+    """(seq, time) of a message or operational log line, or None."""
+    text = line.decode("utf-8", errors="replace")
+    record = parse_record(text)
+    if record:
+        return record.seq or 0, record.timestamp
+    match = LOG_TIME_RE.match(text)
+    if match:
+        return 0, match.group(1)
+    return None
+
+
+class ArchiveIndex:
+    """LogIndex of an archived day, loaded from its .idx file."""
+
+    def __init__(self, path):
+        with open(path + ".idx", "r", encoding="utf-8") as f:
+            index = json.load(f)
+        self.path = path
+        self.offsets = [chunk[0] for chunk in index["chunks"]]
+        self.seq = [chunk[1] for chunk in index["chunks"]]
+        self.timestamp = [chunk[2] for chunk in index["chunks"]]
+        self.last_seq = index["last_seq"]
+
+    def first(self, key):
+        keys = getattr(self, key)
+        return keys[0] if keys else None
+
+    def offset(self, key, value):
+        """Where the member that holds `value` starts."""
+        i = bisect.bisect_right(getattr(self, key), value) - 1
+        return self.offsets[i] if i >= 0 else 0
+
+    def lines(self, start=0):
+        """Decompressed lines from the member at `start` to the end."""
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            with gzip.GzipFile(fileobj=f) as archive:
+                yield from archive
+
+    def after(self, key, value, limit):
+        return records_after(self.lines(self.offset(key, value)), key, value, limit)
+
+
+def archive_file(path):
+    """Compress one finished log into path.gz and path.gz.idx, then remove
+    it. Runs in the archive pool. Returns (bytes before, bytes after).
+    """
+    target = path + ".gz"
+    tmp = f"{target}.{os.getpid()}.tmp"
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            lines = f.readlines()
-            return lines[-HISTORY_LINES:]
-    except FileNotFoundError:
-        return []
-    
+        chunks = []
+        last = None
+
+        with open(path, "rb") as src, open(tmp, "wb") as dst:
+            def write_chunk(lines):
+                keys = None
+                for line in lines:
+                    keys = line_keys(line)
+                    if keys:
+                        break
+                if keys:  # a member with no dated line is just read through
+                    chunks.append([dst.tell(), *keys])
+                dst.write(gzip.compress(b"".join(lines), mtime=0))
+
+            pending = []
+            size = 0
+            for line in src:
+                pending.append(line)
+                size += len(line)
+                if line.strip():
+                    last = line
+                if size >= ARCHIVE_CHUNK:
+                    write_chunk(pending)
+                    pending = []
+                    size = 0
+            if pending:
+                write_chunk(pending)
+            before = src.tell()
+            after = dst.tell()
+            os.fsync(dst.fileno())
+
+        last_keys = line_keys(last) if last else None
+        with open(tmp + ".idx", "w", encoding="utf-8") as f:
+            json.dump({"chunks": chunks, "last_seq": last_keys[0] if last_keys else 0}, f)
+    except BaseException:
+        for leftover in (tmp, tmp + ".idx"):
+            try:
+                os.remove(leftover)
+            except FileNotFoundError:
+                pass
+        raise
+
+    # the .gz goes in place before the plain file disappears, so a reader
+    # always finds one of them
+    os.replace(tmp, target)
+    os.replace(tmp + ".idx", target + ".idx")
+    os.remove(path)
+    return before, after
+
+
+def finished_logs(today):
+    """Plain log files of earlier days that nobody has written to lately."""
+    settled = time.time() - ARCHIVE_SETTLE
+    paths = []
+    for name in sorted(os.listdir(LOG_DIR)):
+        match = LOG_NAME_RE.match(name)
+        if not match or not name.endswith(".txt") or match.group(1) >= today:
+            continue
+        path = os.path.join(LOG_DIR, name)
+        try:
+            if os.path.getmtime(path) < settled:
+                paths.append(path)
+        except FileNotFoundError:
+            pass
+    return paths
+
+
+def prune_logs(today):
+    if not ARCHIVE_KEEP_DAYS:
+        return 0
+
+    cutoff = (date.fromisoformat(today) - timedelta(days=ARCHIVE_KEEP_DAYS)).isoformat()
+    removed = 0
+    for name in os.listdir(LOG_DIR):
+        match = LOG_NAME_RE.match(name)
+        if match and match.group(1) < cutoff:
+            try:
+                os.remove(os.path.join(LOG_DIR, name))
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+archive_pool = None  # ThreadPoolExecutor, started with the first run; zlib releases the GIL
+
+
+async def archive_logs():
+    global archive_pool
+
+    loop = asyncio.get_running_loop()
+    if archive_pool is None:
+        archive_pool = concurrent.futures.ThreadPoolExecutor(ARCHIVE_WORKERS, thread_name_prefix="archiver")
+
+    today = date.today().isoformat()
+    pruned = await loop.run_in_executor(archive_pool, prune_logs, today)
+    paths = await loop.run_in_executor(archive_pool, finished_logs, today)
+    results = await asyncio.gather(
+        *(loop.run_in_executor(archive_pool, archive_file, path) for path in paths),
+        return_exceptions=True,
+    )
+
+    before = after = 0
+    for path, result in zip(paths, results):
+        if isinstance(result, BaseException):
+            log_safe(log_file("errors"), f"ARCHIVE_FAIL {os.path.basename(path)} {result}")
+            continue
+        stats["archived_files"] += 1
+        before += result[0]
+        after += result[1]
+
+    if paths or pruned:
+        log_safe(log_file("server"),
+                 f"ARCHIVE {len(paths)} files, {before} -> {after} bytes, {pruned} pruned")
+
+
+def stop_archiver(task):
+    if task:
+        task.cancel()
+    if archive_pool:
+        archive_pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def run_archiver():
+    while True:
+        try:
+            await archive_logs()
+        except Exception as e:
+            log_safe(log_file("errors"), f"ARCHIVE_FAIL {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+
+# ---------- rooms ----------
+
+def room_log(name, day=None):
+    # the default room keeps the original messages file
+    return log_file("messages" if name == DEFAULT_ROOM else f"messages-{name}", day)
+
+
+class Room:
+    """A channel: who is in it, its replay buffer and its log file.
+
+    Only local members are kept as sessions (they are what a message fans
+    out to); `names` also covers members on other workers, for WHO.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.members = {}  # ws -> Session, this process only
+        self.names = []  # sorted, local and remote
+        self.history = ReplayBuffer(HISTORY_LINES)
+        self.messages = 0
+        self.presence = Presence(self)
+        self._who = None
+
+    def add(self, nickname, session=None):
+        if session is not None:
+            self.members[session.ws] = session
+        i = bisect.bisect_left(self.names, nickname)
+        if i == len(self.names) or self.names[i] != nickname:
+            self.names.insert(i, nickname)
+        self._who = None
+
+    def discard(self, nickname, ws=None):
+        if ws is not None:
+            self.members.pop(ws, None)
+        i = bisect.bisect_left(self.names, nickname)
+        if i < len(self.names) and self.names[i] == nickname:
+            del self.names[i]
+        self._who = None
+
+    def who(self):
+        if self._who is None:
+            self._who = f"SYS Online in #{self.name} ({len(self.names)}): " + ", ".join(self.names)
+        return self._who
+
+
+rooms = {}  # name -> Room, only while someone (anywhere) is in it
+
+
+def open_room(name):
+    room = rooms.get(name)
+    if room is None:
+        room = rooms[name] = Room(name)
+        room.history.warm(room_log(name))
+    return room
+
+
+def close_room(room):
+    # empty rooms are forgotten; their history is read back from the log
+    # file if somebody joins again
+    if not room.names and room.name != DEFAULT_ROOM:
+        rooms.pop(room.name, None)
+
+
+def enter_room(session, room):
+    session.room = room
+    room.add(session.nickname, session)
+
+
+def leave_room(session):
+    room = session.room
+    if room is not None:
+        room.discard(session.nickname, session.ws)
+        close_room(room)
+    return room
+
+
+def move(session, room):
+    old = leave_room(session)
+    broadcast(f"SYS {session.nickname} left #{old.name}", old)
+    link = bus or predecessor
+    if link:
+        link.send({"op": "move", "nick": session.nickname, "from": old.name, "room": room.name})
+
+    enter_room(session, room)
+    broadcast(f"SYS {session.nickname} joined #{room.name}", room)
+    send_replay(session, room)
+
+
+def presence_line(names, verb):
+    if len(names) == 1:
+        return f"SYS {names[0]} {verb} the chat!"
+
+    listed = ", ".join(names[:PRESENCE_NAMES])
+    if len(names) > PRESENCE_NAMES:
+        listed += f" and {len(names) - PRESENCE_NAMES} more"
+    return f"SYS {len(names)} users {verb}: {listed}"
+
+
+class Presence:
+    """Join/leave notices for one room.
+
+    Up to PRESENCE_QUIET notices per PRESENCE_WINDOW go out one by one, as
+    they always have. Past that the room is busy: notices are held until
+    the window ends and sent as one line per kind, so N clients coming
+    back after a restart no longer cost N notices to each of them. The
+    room stays in summary mode until a whole window goes by quietly. A
+    client that leaves and comes back within the window (or the other way
+    round) is not announced at all.
+    """
+
+    def __init__(self, room):
+        self.room = room
+        self.window = 0.0  # monotonic start of the current window
+        self.sent = 0      # notices sent one by one in it
+        self.joined = {}   # nickname -> None, held for the summary (a dict keeps the order)
+        self.left = {}
+        self.timer = None
+
+    def announce(self, nickname, joined):
+        """Tell the room; False if the notice was held for a summary."""
+        now = time.monotonic()
+        if self.timer is None and now - self.window >= PRESENCE_WINDOW:
+            self.window = now
+            self.sent = 0
+
+        if self.timer is None and self.sent < PRESENCE_QUIET:
+            self.sent += 1
+            broadcast(presence_line([nickname], "joined" if joined else "left"), self.room)
+            return True
+
+        held, opposite = (self.joined, self.left) if joined else (self.left, self.joined)
+        if nickname in opposite:
+            del opposite[nickname]
+        else:
+            held[nickname] = None
+        stats["presence_coalesced"] += 1
+
+        if self.timer is None:
+            delay = max(0.0, self.window + PRESENCE_WINDOW - now)
+            self.timer = asyncio.get_running_loop().call_later(delay, self.flush)
+        return False
+
+    def flush(self):
+        self.timer = None
+        for held, verb in ((self.left, "left"), (self.joined, "joined")):
+            if held:
+                # every held joiner was told it got in already
+                skip = held if verb == "joined" else ()
+                broadcast(presence_line(list(held), verb), self.room, skip)
+                held.clear()
+
+        self.window = time.monotonic()
+        self.sent = PRESENCE_QUIET
+
+
+def send_replay(session, room, replay=None, skipped=0):
+    if replay is None:
+        replay = room.history.recent()
+    if not replay:
+        return
+
+    numbered = "seq" in session.caps
+    note = f", {skipped} older skipped" if skipped else ""
+    session.outbox.send(f"SYS Replay start ({len(replay)} messages{note})")
+    for record in replay:
+        session.outbox.send(record.frame(numbered))
+    session.outbox.send("SYS Replay end")
+
+
+async def replay_since(session, arg):
+    """REPLAY SINCE <seq|timestamp> for the session's room: from the replay
+    buffer when it reaches back far enough, otherwise from the log files.
+    """
+    # isdigit() also takes "²", which int() does not
+    if arg.isascii() and arg.isdecimal():
+        key, value = "seq", int(arg)
+    else:
+        try:
+            value = datetime.fromisoformat(arg).isoformat(timespec="seconds")
+        except ValueError:
+            session.outbox.send("ERR Expected: REPLAY SINCE <seq|timestamp>")
+            return
+        key = "timestamp"
+
+    room = session.room
+    records = room.history.since(key, value)
+    skipped = 0
+
+    if records is None:
+        try:
+            if not bus:
+                # whatever is still queued for the log has to be on disk first
+                await asyncio.to_thread(log_writer.sync)
+            # REPLAY_MAX is a setting: pass the current value, a reload may change it
+            records, total = await asyncio.to_thread(read_since, room.name, key, value, REPLAY_MAX)
+        except Exception as e:
+            # e.g. an archive caught before its index was written, or a
+            # file pruned while it was read
+            log_safe(log_file("errors"), f"REPLAY_FAIL {session.nickname} {room.name} {arg} {e}")
+            session.outbox.send("ERR Replay failed, try again")
+            return
+        skipped = total - len(records)
+
+    if not records:
+        session.outbox.send("SYS Replay start (0 messages)")
+        session.outbox.send("SYS Replay end")
+        return
+
+    send_replay(session, room, records, skipped)
+
+
+def publish(record, room):
+    # with workers, the hub numbers and persists the record and hands it
+    # back to every worker (us included) in one global order
+    if bus:
+        bus.send({"op": "publish", "room": room.name, "record": record.pack()})
+        return
+
+    record.seq = next(sequence)
+    persist_message(room_log(room.name), record.log_line())
+    apply_record(record, room)
+    if predecessor:
+        predecessor.send({"op": "record", "room": room.name, "record": record.pack()})
+
+
+def apply_record(record, room):
+    stats["messages_session"] += 1
+    if room is None:
+        return  # a room nobody here is in
+
+    room.messages += 1
+    room.history.append(record)
+
+    # one shared frame per format, built only if somebody needs it
+    created = time.perf_counter()
+    plain = numbered = None
+    for session in room.members.values():
+        if "seq" in session.caps:
+            if numbered is None:
+                numbered = Frame(record.frame(True), created)
+            session.outbox.put(numbered)
+        else:
+            if plain is None:
+                plain = Frame(record.frame(), created)
+            session.outbox.put(plain)
+
+
 async def shutdown_server():
-    restarting = is_restart()
+    # after a handoff the clients still here find the new process on reconnect
+    restarting = is_restart() or handing_off
 
     if restarting:
         msg = "SYS Server restarting"
@@ -179,23 +1646,22 @@ async def shutdown_server():
         msg = "SYS Server shutting down"
         log_safe(log_file("server"), "SERVER_SHUTDOWN")
 
-    for ws in list(clients.keys()):
-        try:
-            await asyncio.wait_for(ws.send(msg), timeout=2)
-        except Exception:
-            pass
+    # every worker says this to its own clients, each with its own retry
+    # hint so they do not all come back in the same second
+    for session in list(sessions.by_ws.values()):
+        retry = random.randint(*RESTART_RETRY) if restarting else SHUTDOWN_RETRY
+        session.outbox.send(f"{msg}, retry in {retry}s")
 
-        try:
-            await asyncio.wait_for(
-                ws.close(
-                    code=1001,
-                    reason="Server restart" if restarting else "Server shutdown"
-                ),
-                timeout=2
-            )
-        except Exception:
-            pass
+    await asyncio.gather(*(
+        outbox.close(
+            code=1001,
+            reason="Server restart" if restarting else "Server shutdown"
+        )
+        for outbox in [s.outbox for s in sessions.by_ws.values()]
+    ))
 
+    # make sure everything logged so far is on disk before we go away
+    await asyncio.to_thread(log_writer.sync)
 
 
 def format_uptime(seconds):
@@ -221,6 +1687,10 @@ LEET_MAP = str.maketrans({
     "@": "a",
     "$": "s",
     "!": "i",
+    # dotless i / long s: the only non-ASCII letters that used to match
+    # the (ASCII) forbidden list through re.IGNORECASE
+    "\u0131": "i",
+    "\u017f": "s",
 })
 
 def normalise(text):
@@ -237,280 +1707,1761 @@ def normalise(text):
     return text
 
 
+# floods repeat the same text, so verdicts are cached on the raw text and
+# normalise() only runs for lines not seen lately
+moderation_cache = OrderedDict()
+
+
 def contains_forbidden(text):
-    norm = normalise(text)
+    start = time.perf_counter()
+    found = moderation_cache.get(text)
+
+    if found is None:
+        stats["moderation_misses"] += 1
+        found = FORBIDDEN_MATCHER.search(normalise(text)) is not None
+        if MODERATION_CACHE_SIZE:
+            moderation_cache[text] = found
+            if len(moderation_cache) > MODERATION_CACHE_SIZE:
+                moderation_cache.popitem(last=False)
+    else:
+        stats["moderation_hits"] += 1
+        moderation_cache.move_to_end(text)
 
-    for pattern in FORBIDDEN_PATTERNS:
-        if pattern.search(norm):
-            return True
+    MODERATION_LATENCY.observe(time.perf_counter() - start)
+    return found
 
-    return False
 
+def is_duplicate(session, text):
+    """True if `session` already sent `text` within DUPLICATE_WINDOW."""
+    if not DUPLICATE_WINDOW:
+        return False
 
-# ---------- client handler ----------
+    now = time.monotonic()
+    recent = session.recent
+    if recent is None:
+        recent = session.recent = OrderedDict()
+    while recent and now - next(iter(recent.values())) >= DUPLICATE_WINDOW:
+        recent.popitem(last=False)
 
-async def handle_client(websocket):
-    peer = websocket.remote_address
-    log_safe(log_file("connections"), f"CONNECT_ATTEMPT {peer}")
+    if text in recent:
+        stats["duplicates"] += 1
+        return True
 
-    await websocket.send("SYS Protocol wirechat/1\n")
-    await websocket.send("SYS Send: NICK <name>")
+    recent[text] = now
+    if len(recent) > DUPLICATE_TRACK:
+        recent.popitem(last=False)
+    return False
 
-    try:
-        raw = await websocket.recv()
-    except Exception as e:
-        log_safe(log_file("errors"), f"HANDSHAKE_FAIL {peer} {e}")
-        return
 
-    if not raw.startswith("NICK "):
-        await websocket.send("ERR Expected: NICK <name>")
-        log_safe(log_file("errors"), f"BAD_HANDSHAKE {peer} {raw!r}")
-        await websocket.close()
-        return
+# ---------- instrumentation ----------
 
-    nickname = raw[5:].strip()
+class Histogram:
+    """Latency histogram with fixed bucket bounds (seconds)."""
 
-    if not valid_nickname(nickname):
-        await websocket.send("ERR Invalid nickname")
-        log_safe(log_file("errors"), f"BAD_NICK {peer} {nickname!r}")
-        await websocket.close()
-        return
+    BOUNDS = (
+        0.00005, 0.0001, 0.00025, 0.0005,
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    )
 
-    if nickname in clients.values():
-        await websocket.send("ERR Nickname already in use")
-        log_safe(log_file("errors"), f"DUPLICATE_NICK {peer} {nickname}")
-        await websocket.close()
-        return
-    
-    if contains_forbidden(nickname):
-        await websocket.send("ERR Nickname contains forbidden words")
-        await websocket.close()
-        return
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
 
-    clients[websocket] = nickname
-    log_safe(log_file("connections"), f"CONNECT {nickname} {peer}")
-    await broadcast(f"SYS {nickname} joined the chat!")
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
 
-    history = load_recent_messages()
-    if history:
-        await websocket.send(
-            f"SYS Replay start ({len(history)} messages)"
-        )
+    def percentile(self, q):
+        # upper bound of the bucket the q-th observation falls in
+        if not self.count:
+            return 0.0
 
-        for line in history:
-            line = line.strip()
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.BOUNDS, self.buckets):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
 
-            # replay images properly
-            if ": [IMG] " in line:
-                # format: [time] nick: [IMG] url
-                prefix, url = line.split(": [IMG] ", 1)
 
-                # prefix is "[time] nick"
-                parts = prefix.split(" ", 1)
+def format_ms(seconds):
+    if seconds == float("inf"):
+        return f">{Histogram.BOUNDS[-1] * 1000:g}ms"
+    return f"{seconds * 1000:g}ms"
 
-                if len(parts) == 2:
-                    timestamp = parts[0][1:-1]  # remove [ ]
-                    sender = parts[1]
 
-                    await websocket.send(f"IMG [{timestamp}] {sender} {url}")
-                else:
-                    await websocket.send(f"MSG {line}")
+PERCENTILES = {"p50": 0.5, "p99": 0.99, "p999": 0.999}
 
-            else:
-                await websocket.send(f"MSG {line}")
 
+def format_percentiles(histogram, names=("p50", "p99", "p999")):
+    return " ".join(
+        f"{name} {format_ms(histogram.percentile(PERCENTILES[name]))}"
+        for name in names
+    )
 
-        await websocket.send("SYS Replay end")
 
-    # --- message loop ---
-    try:
-        async for raw in websocket:
-            raw = raw.strip()
-            if len(raw) > MAX_MSG_LEN:
-                await websocket.send("ERR Message too large")
-                log_safe(log_file("errors"), f"MSG_TOO_LARGE {nickname}")
-                await websocket.close(code=1009)
-                break
+class Rate:
+    """Per-second rate of a `stats` counter over the last RATE_WINDOW seconds."""
 
-            if raw == "QUIT":
-                log_safe(log_file("connections"), f"QUIT {nickname}")
-                break
+    def __init__(self, key):
+        self.key = key
+        self.samples = deque(maxlen=RATE_WINDOW + 1)
 
-            if raw == "WHO":
-                names = sorted(clients.values())
-                await websocket.send(f"SYS Online ({len(names)}): " + ", ".join(names))
-                continue
+    def sample(self, now):
+        self.samples.append((now, stats[self.key]))
 
-            if raw == "VERSION":
-                await websocket.send(f"SYS Wirechat server v{VERSION}")
-                continue
+    def per_second(self):
+        if len(self.samples) < 2:
+            return 0.0
+        (t0, c0), (t1, c1) = self.samples[0], self.samples[-1]
+        return (c1 - c0) / (t1 - t0) if t1 > t0 else 0.0
 
-            if raw == "CMDS":
-                lines = ["Available commands:"]
-                for name, desc in sorted(COMMAND_HELP.items()):
-                    lines.append(f"/{name.lower()} – {desc}")
 
-                await websocket.send("SYS " + " | ".join(lines))
-                
-                if websocket in admins:
-                    lines = ["Available admin commands:"]
-                    for name, desc in sorted(COMMAND_ADMIN.items()):
-                        lines.append(f"/{name.lower()} – {desc}")
+FANOUT_LATENCY = Histogram()      # broadcast() -> frame written, per client
+HANDSHAKE_LATENCY = Histogram()   # connection opened -> joined and replay queued
+MODERATION_LATENCY = Histogram()  # contains_forbidden(), per call
 
-                    await websocket.send("SYS " + " | ".join(lines))
-                    
-                continue
+RATES = {
+    "in": Rate("frames_in"),
+    "out": Rate("frames_out"),
+}
 
-            if raw == "PING":
-                await websocket.send("PONG")
-                continue
 
-            if raw == "UPTIME":
-                uptime = time.monotonic() - SERVER_START_TIME
-                await websocket.send(f"SYS Uptime: {format_uptime(uptime)}")   
-                continue
+async def sample_rates():
+    while True:
+        now = time.monotonic()
+        for rate in RATES.values():
+            rate.sample(now)
+        await asyncio.sleep(1)
 
-            if raw == "STATS":
-                uptime = time.monotonic() - SERVER_START_TIME
-                await websocket.send(
-                    f"SYS Users: {len(clients)} | "
-                    f"Uptime: {format_uptime(uptime)} | "
-                    f"Messages (session): {stats['messages_session']}"
-                )
-                continue
-            
-            if raw.startswith("ADMIN "):
-                token = raw[6:].strip()
-
-                if token == ADMIN_TOKEN:
-                    admins.add(websocket)
-                    await websocket.send("SYS Admin privileges granted")
-                    log_safe(log_file("server"), f"ADMIN_GRANTED {clients.get(websocket)}")
-                else:
-                    await websocket.send("ERR Invalid admin token")
+# ---------- rate limiting ----------
 
-                continue
-            
-            if raw.startswith("KICK "):
-                if websocket not in admins:
-                    await websocket.send("ERR Admin only command")
-                    continue
+class TokenBucket:
+    """Refills `rate` tokens per second, holding at most `burst`."""
 
-                target = raw[5:].strip()
+    __slots__ = ("rate", "burst", "tokens", "updated")
 
-                # find websocket for that nickname
-                target_ws = None
-                for ws, name in clients.items():
-                    if name.lower() == target.lower():
-                        target_ws = ws
-                        break
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
 
-                if not target_ws:
-                    await websocket.send(f"ERR User not found: {target}")
-                    continue
+    def wait(self, now):
+        """Seconds until a token is available, 0.0 if one is now."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
 
-                name = clients.get(target_ws)
+    def resize(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = min(self.tokens, burst)
 
-                # mark as kicked and close connection
-                kicked.add(target_ws)
-                try:
-                    await target_ws.send("SYS You were kicked by an admin")
-                except:
-                    pass
 
-                await target_ws.close(code=4000, reason="Kicked by admin")
+def rate_limits():
+    """bucket name -> (tokens per second, burst), from the current settings."""
+    return {"msg": RATE_MSG, "img": RATE_IMG, "cmd": RATE_CMD}
 
-                if name:
-                    await broadcast(f"SYS {name} was kicked by an admin")
-                    log_safe(log_file("server"), f"KICK {name}")
 
-                continue
-            
-            if raw.startswith("IMG"):
+def apply_rate_limits():
+    # after a reload: buckets already handed out take the new limits too
+    RATE_LIMITS.update(rate_limits())
+    global_bucket.resize(RATE_GLOBAL[0] / WORKERS, RATE_GLOBAL[1] / WORKERS)
+    for session in sessions.by_ws.values():
+        for name, bucket in session.buckets.items():
+            bucket.resize(*RATE_LIMITS[name])
 
-                parts = raw.split(" ", 1)
 
-                if len(parts) == 1 or not parts[1].strip():
-                    await websocket.send("ERR IMG requires a URL")
-                    continue
+RATE_LIMITS = rate_limits()
+global_bucket = TokenBucket(RATE_GLOBAL[0] / WORKERS, RATE_GLOBAL[1] / WORKERS)
 
-                url = parts[1].strip()
+throttled = {"msg": 0, "img": 0, "cmd": 0, "global": 0}  # throttled frames per bucket
 
-                if not re.match(r"^https?://\S+$", url):
-                    await websocket.send("ERR Invalid image URL")
-                    continue
 
-                timestamp = datetime.now().isoformat(timespec="seconds")
-                sender = clients.get(websocket, "unknown")
+def throttle(session, raw, retry=False):
+    """Charge an inbound frame to its buckets.
 
-                line = f"[{timestamp}] {sender} {url}"
+    Returns 0.0 once the frame has been paid for, otherwise how long to wait
+    before trying again (nothing is taken then). A frame counts as
+    throttled only on its first try.
+    """
+    if raw.startswith("MSG "):
+        name = "msg"
+    elif raw.startswith("IMG "):
+        name = "img"
+    else:
+        name = "cmd"
+
+    now = time.monotonic()
+    own = session.buckets.get(name)
+    if own is None:
+        own = session.buckets[name] = TokenBucket(*RATE_LIMITS[name])
+    wait = own.wait(now)
+    # only MSG/IMG cost a broadcast and a log write, so only they share
+    shared = global_bucket.wait(now) if name != "cmd" else 0.0
+
+    if not wait and not shared:
+        own.tokens -= 1
+        if name != "cmd":
+            global_bucket.tokens -= 1
+        return 0.0
+
+    if not retry:
+        bucket = name if wait else "global"
+        throttled[bucket] += 1
+        session.throttled += 1
+        if session.throttle_logged is None or now - session.throttle_logged >= RATE_LOG_INTERVAL:
+            log_safe(log_file("errors"),
+                     f"THROTTLED {session.nickname} {bucket} {RATE_POLICY} x{session.throttled}")
+            session.throttled = 0
+            session.throttle_logged = now
+
+    return max(wait, shared)
+
+# ---------- reload ----------
+
+# bumped when a reload starts; a reload that finishes after a newer one
+# started would swap in stale files, so it is dropped
+reload_generation = itertools.count(1)
+reload_applied = 0
+
+
+def read_config():
+    """Everything a reload needs, built from the files (runs in a thread)."""
+    start = time.perf_counter()
+    words, matcher = load_matcher()
+    matcher.compile()
+    build = time.perf_counter() - start
+    return words, matcher, build, load_settings(), load_admin_token()
+
+
+async def reload_config(reason):
+    """Re-read forbidden.txt, server.txt and the admin token and swap them in.
+
+    The files are read and the matcher compiled off the event loop; the
+    swap itself has no awaits, so every message is checked against either
+    the old state or the new one. Returns a summary for the admin, raises
+    (leaving the old state in place) if a file is broken.
+    """
+    global FORBIDDEN, FORBIDDEN_MATCHER, ADMIN_TOKEN, reload_applied
+
+    generation = next(reload_generation)
+    start = time.perf_counter()
+    try:
+        words, matcher, build, settings, token = await asyncio.to_thread(read_config)
+    except Exception as e:
+        log_safe(log_file("errors"), f"RELOAD_FAIL {reason} {e}")
+        raise
+
+    if generation < reload_applied:
+        return "Reload superseded by a newer one"
+
+    FORBIDDEN, FORBIDDEN_MATCHER = words, matcher
+    moderation_cache.clear()
+    if token:
+        ADMIN_TOKEN = token
+    changed = [f"{name}={value}" for name, value in settings.items() if globals()[name] != value]
+    globals().update(settings)
+    for room in rooms.values():
+        room.history.resize(HISTORY_LINES)
+    apply_rate_limits()
+    reload_applied = generation
+
+    elapsed = time.perf_counter() - start
+    stats["reloads"] += 1
+    stats["reload_seconds"] = elapsed
+    summary = (
+        f"Reloaded in {elapsed * 1000:.1f}ms (matcher {matcher.source} {build * 1000:.1f}ms): "
+        f"{len(words)} forbidden entries | Changed: {', '.join(changed) or 'nothing'}"
+    )
+    log_safe(log_file("server"), f"RELOAD {reason} {summary}")
+    return summary
 
-                stats["messages_session"] += 1
 
-                persist_message(
-                    f"{LOG_DIR}/{date.today().isoformat()}-messages.txt",
-                    f"[{timestamp}] {sender}: [IMG] {url}"
-                )
+async def reload_quietly(reason):
+    # for SIGHUP, the watcher and the bus: failures are already logged
+    try:
+        await reload_config(reason)
+    except Exception:
+        pass
 
-                await broadcast(f"IMG {line}")
-                continue
 
+def config_mtimes():
+    mtimes = {}
+    for name in ("forbidden.txt", "server.txt", "secrets.txt"):
+        try:
+            mtimes[name] = os.stat(os.path.join(CONFIG_PATH, name)).st_mtime_ns
+        except OSError:
+            mtimes[name] = None
+    return mtimes
 
 
-            if not raw.startswith("MSG "):
-                await websocket.send("ERR Expected: MSG <text>")
-                log_safe(log_file("errors"), f"BAD_MSG {nickname} {raw!r}")
-                continue
-            
+async def watch_config():
+    seen = config_mtimes()
+    while True:
+        await asyncio.sleep(CONFIG_WATCH_INTERVAL)
+        current = config_mtimes()
+        if current != seen:
+            seen = current
+            await reload_quietly("watch")
 
+# ---------- profiling ----------
 
-            text = raw[4:].strip()
-            
-            if contains_forbidden(text):
-                await websocket.send("ERR Message contains forbidden content")
-                continue
-            timestamp = datetime.now().isoformat(timespec="seconds")
-            sender = clients.get(websocket, "unknown")
+LOOP_LAG = Histogram()  # how late each lag probe woke up
 
-            line = f"[{timestamp}] {sender}: {text}"
-            stats['messages_session'] += 1
-            today = date.today().isoformat()
-            persist_message(
-                f"{LOG_DIR}/{today}-messages.txt",
-                line
-            )  
+profiler = None          # cProfile.Profile while a profile is running
+profile_started = None   # monotonic time it started
+profile_timer = None     # stops it after PROFILE_MAX_SECONDS
 
-            await broadcast(f"MSG {line}")
 
-    except ConnectionClosed:
-        # normal disconnect (quit, kick, network drop)
-        pass
+def start_profile(reason):
+    """Start profiling the event loop thread; False if already running."""
+    global profiler, profile_started, profile_timer
+
+    if profiler is not None:
+        return False
+
+    profiler = cProfile.Profile()
+    profile_started = time.monotonic()
+    profile_timer = asyncio.get_running_loop().call_later(
+        PROFILE_MAX_SECONDS, lambda: asyncio.ensure_future(stop_profile("time limit"))
+    )
+    log_safe(log_file("server"), f"PROFILE_START {reason}")
+    profiler.enable()
+    return True
+
+
+def write_profile(profile, path):
+    # <path>.prof for pstats / snakeviz, <path>.prof.txt to read right away
+    profile.dump_stats(path)
+    with open(path + ".txt", "w", encoding="utf-8") as f:
+        report = pstats.Stats(profile, stream=f)
+        for key in ("cumulative", "tottime"):
+            f.write(f"===== sorted by {key} =====\n")
+            report.sort_stats(key).print_stats(PROFILE_TOP)
+
+
+async def stop_profile(reason):
+    """Stop profiling and write the results; returns the .prof path, None if not running."""
+    global profiler
+
+    if profiler is None:
+        return None
+
+    profile, profiler = profiler, None
+    profile.disable()
+    profile_timer.cancel()
+    seconds = time.monotonic() - profile_started
+
+    worker = f"-w{WORKER_ID}" if WORKER_ID is not None else ""
+    path = os.path.join(LOG_DIR, f"{date.today().isoformat()}-profile-{datetime.now():%H%M%S}{worker}.prof")
+    await asyncio.to_thread(write_profile, profile, path)
+
+    log_safe(log_file("server"), f"PROFILE_STOP {reason} after {seconds:.0f}s -> {os.path.basename(path)}")
+    return path
+
+
+def toggle_profile():
+    # SIGUSR1: start, or stop and write out
+    if profiler is None:
+        start_profile("SIGUSR1")
+    else:
+        asyncio.ensure_future(stop_profile("SIGUSR1"))
+
+
+class LagMonitor:
+    """Logs whenever something blocks the event loop for too long.
+
+    A probe sleeps LOOP_LAG_INTERVAL at a time and measures how late it
+    woke up. A blocked loop cannot say what is blocking it, so a watchdog
+    thread also looks at the loop thread's stack once the probe is overdue.
+    The stack it catches goes into the LOOP_LAG line for that stall.
+    """
+
+    def __init__(self):
+        self.beat = time.monotonic()  # when the probe last ran
+        self.caught = None            # (beat, stack) seen by the watchdog during a stall
+        self.thread_id = None
+        self.stopped = threading.Event()
+
+    async def run(self):
+        self.thread_id = threading.get_ident()
+        threading.Thread(target=self.watch, name="lag-watchdog", daemon=True).start()
+        try:
+            while True:
+                expected = time.monotonic() + LOOP_LAG_INTERVAL
+                await asyncio.sleep(LOOP_LAG_INTERVAL)
+
+                now = time.monotonic()
+                beat, self.beat = self.beat, now
+                lag = max(0.0, now - expected)
+                LOOP_LAG.observe(lag)
+                if lag <= LOOP_LAG_THRESHOLD:
+                    continue
+
+                stats["loop_stalls"] += 1
+                stats["loop_lag_worst"] = max(stats["loop_lag_worst"], lag)
+                caught, self.caught = self.caught, None
+                where = f" in {caught[1]}" if caught and caught[0] == beat else ""
+                log_safe(log_file("lag"), f"LOOP_LAG {lag * 1000:.0f}ms{where}")
+        finally:
+            self.stopped.set()
+
+    def watch(self):
+        while not self.stopped.wait(LOOP_LAG_INTERVAL):
+            beat = self.beat
+            if self.caught or time.monotonic() - beat < LOOP_LAG_INTERVAL + LOOP_LAG_THRESHOLD:
+                continue
+
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+
+            # innermost first, that is where the time goes
+            stack = traceback.extract_stack(frame)[-8:]
+            self.caught = (beat, " <- ".join(
+                f"{os.path.basename(f.filename)}:{f.lineno} {f.name}" for f in reversed(stack)
+            ))
+
+# ---------- commands ----------
+
+class Command:
+    def __init__(self, name, handler, help, admin):
+        self.name = name
+        self.handler = handler
+        self.help = help
+        self.admin = admin
+        self.calls = 0
+        self.latency = Histogram()
+
+
+COMMANDS = {}  # first token -> Command
+
+
+def command(name, help=None, admin=False):
+    """Register a handler for frames starting with `name`.
+
+    Handlers are called as handler(session, arg) and return True to end
+    the session.
+    """
+    def register(handler):
+        COMMANDS[name] = Command(name, handler, help, admin)
+        return handler
+    return register
+
+
+async def dispatch(session, raw):
+    # MSG is by far the most common frame, so it skips the split and lookup
+    if raw.startswith("MSG "):
+        cmd, arg = MSG_COMMAND, raw[4:]
+    else:
+        name, _, arg = raw.partition(" ")
+        cmd = COMMANDS.get(name)
+
+    if cmd is None:
+        session.outbox.send("ERR Expected: MSG <text>")
+        log_safe(log_file("errors"), f"BAD_MSG {session.nickname} {raw!r}")
+        return False
+
+    if cmd.admin and not session.admin:
+        session.outbox.send("ERR Admin only command")
+        return False
+
+    start = time.perf_counter()
+    try:
+        return await cmd.handler(session, arg.strip())
+    finally:
+        cmd.calls += 1
+        cmd.latency.observe(time.perf_counter() - start)
+
+
+def help_lines(title, table):
+    lines = [title]
+    for name, desc in sorted(table.items()):
+        lines.append(f"/{name.lower()} – {desc}")
+    return "SYS " + " | ".join(lines)
+
+
+@command("MSG")
+async def cmd_msg(session, text):
+    if not text:
+        session.outbox.send("ERR Expected: MSG <text>")
+        return
+
+    # moderation first, so a refused line is not remembered as sent
+    if contains_forbidden(text):
+        session.outbox.send("ERR Message contains forbidden content")
+        return
+
+    if is_duplicate(session, text):
+        session.outbox.send("ERR Duplicate message")
+        return
+
+    timestamp = datetime.now().isoformat(timespec="seconds")
+    session.messages += 1
+    publish(Record("MSG", timestamp, session.nickname, text), session.room)
+
+
+@command("IMG", "Sends an image")
+async def cmd_img(session, url):
+    if not url:
+        session.outbox.send("ERR IMG requires a URL")
+        return
+
+    if not re.match(r"^https?://\S+$", url):
+        session.outbox.send("ERR Invalid image URL")
+        return
+
+    if is_duplicate(session, url):
+        session.outbox.send("ERR Duplicate message")
+        return
+
+    timestamp = datetime.now().isoformat(timespec="seconds")
+    session.messages += 1
+    publish(Record("IMG", timestamp, session.nickname, url), session.room)
+
+
+@command("QUIT", "Disconnect from the server")
+async def cmd_quit(session, arg):
+    log_safe(log_file("connections"), f"QUIT {session.nickname}")
+    return True
+
+
+@command("WHO", "List users in your room (WHO <room>, WHO * for everyone)")
+async def cmd_who(session, arg):
+    if arg == "*":
+        session.outbox.send(sessions.who())
+        return
+
+    room = rooms.get(arg.lstrip("#").lower()) if arg else session.room
+    if room is None:
+        session.outbox.send(f"ERR No such room: {arg}")
+        return
+
+    session.outbox.send(room.who())
+
+
+@command("JOIN", "Switch to a room, creating it if needed")
+async def cmd_join(session, arg):
+    name = arg.lstrip("#").lower()
+
+    if not valid_room(name) or contains_forbidden(name):
+        session.outbox.send("ERR Invalid room name")
+        return
+
+    if session.room.name == name:
+        session.outbox.send(f"SYS You are already in #{name}")
+        return
+
+    if name not in rooms and len(rooms) >= MAX_ROOMS:
+        session.outbox.send("ERR Too many rooms")
+        return
+
+    if name not in rooms and not bus:
+        # the room may have been emptied a moment ago: let its last lines
+        # reach the log file before we read them back
+        await asyncio.to_thread(log_writer.sync)
+
+    move(session, open_room(name))
+
+
+@command("PART", "Leave your room and go back to the lobby")
+async def cmd_part(session, arg):
+    if session.room.name == DEFAULT_ROOM:
+        session.outbox.send(f"ERR You are already in #{DEFAULT_ROOM}")
+        return
+
+    move(session, rooms[DEFAULT_ROOM])
+
+
+@command("ROOMS", "List rooms")
+async def cmd_rooms(session, arg):
+    listed = sorted(rooms.values(), key=lambda r: (-len(r.names), r.name))
+    session.outbox.send(
+        f"SYS Rooms ({len(listed)}): "
+        + ", ".join(f"#{r.name} ({len(r.names)})" for r in listed)
+    )
+
+
+@command("VERSION", "Get server and client version")
+async def cmd_version(session, arg):
+    session.outbox.send(f"SYS Wirechat server v{VERSION}")
+
+
+@command("CMDS", "Show available commands")
+async def cmd_cmds(session, arg):
+    session.outbox.send(help_lines("Available commands:", COMMAND_HELP))
+
+    if session.admin:
+        session.outbox.send(help_lines("Available admin commands:", COMMAND_ADMIN))
+
+
+command("HELP", "An alias of CMDS")(cmd_cmds)
+
+
+@command("PING", "A simple PING PONG command")
+async def cmd_ping(session, arg):
+    session.outbox.send("PONG")
+
+
+@command("UPTIME", "Get uptime")
+async def cmd_uptime(session, arg):
+    uptime = time.monotonic() - SERVER_START_TIME
+    session.outbox.send(f"SYS Uptime: {format_uptime(uptime)}")
+
+
+@command("STATS", "Get server stats")
+async def cmd_stats(session, arg):
+    uptime = time.monotonic() - SERVER_START_TIME
+    session.outbox.send(
+        f"SYS Users: {len(sessions.names)} | "
+        f"Uptime: {format_uptime(uptime)} | "
+        f"Messages (session): {stats['messages_session']} | "
+        f"Room: #{session.room.name} ({len(session.room.names)} users, {session.room.messages} messages)"
+    )
+
+    if not session.admin:
+        return
+
+    depth, deepest = outbox_depths()
+    session.outbox.send(
+        f"SYS Rate: {RATES['in'].per_second():.1f} in/s, {RATES['out'].per_second():.1f} out/s | "
+        f"Fan-out: {format_percentiles(FANOUT_LATENCY)} | "
+        f"Handshake: {format_percentiles(HANDSHAKE_LATENCY)} | "
+        f"Moderation: {format_percentiles(MODERATION_LATENCY)} "
+        f"(cache {stats['moderation_hits']} hits, {stats['moderation_misses']} misses)"
+    )
+    session.outbox.send(
+        f"SYS Outbox: {depth} queued (max {deepest}, peak {stats['outbox_peak']}) | "
+        f"Dropped: {stats['outbox_dropped']} | "
+        f"Lagging: {stats['outbox_lagging']} | "
+        f"Evicted: {stats['outbox_evictions']} | "
+        f"Batched: {stats['batch_lines']} lines in {stats['batch_frames']} frames | "
+        f"Log backlog: {log_writer.backlog()}"
+    )
+    session.outbox.send(
+        f"SYS Throttled ({RATE_POLICY}): " +
+        ", ".join(f"{name} {n}" for name, n in throttled.items()) +
+        f" | Duplicates: {stats['duplicates']}"
+    )
+    session.outbox.send(
+        f"SYS Connections: {open_connections} open, {upgrading} upgrading"
+        f" (cap {connection_cap or 'none'}, {MAX_PER_IP or 'no limit'} per address) | "
+        f"Refused: {stats['refused_full']} full, {stats['refused_ip']} per address, "
+        f"{stats['refused_upgrading']} upgrading | "
+        f"Handshake timeouts: {stats['handshake_timeouts']} | "
+        f"Idle reaped: {stats['idle_reaped']} | "
+        f"Presence notices coalesced: {stats['presence_coalesced']}"
+    )
+    session.outbox.send(
+        f"SYS Loop lag: {format_percentiles(LOOP_LAG)} | "
+        f"Stalls over {LOOP_LAG_THRESHOLD * 1000:.0f}ms: {stats['loop_stalls']} "
+        f"(worst {stats['loop_lag_worst'] * 1000:.0f}ms) | "
+        f"Profiler: {f'running for {time.monotonic() - profile_started:.0f}s' if profiler else 'off'}"
+    )
+
+    if bus and not handing_off:
+        peers = list(bus.peers.values())
+        session.outbox.send(
+            f"SYS Cluster: worker {bus.worker_id} of {len(peers) + 1} | "
+            f"Local users: {len(sessions)} | "
+            f"Cluster in/out: {stats['frames_in'] + sum(p['frames_in'] for p in peers)}"
+            f"/{stats['frames_out'] + sum(p['frames_out'] for p in peers)} frames"
+        )
+
+    used = sorted(
+        (c for c in COMMANDS.values() if c.calls),
+        key=lambda c: c.latency.sum,
+        reverse=True,
+    )
+    if used:
+        session.outbox.send("SYS Commands: " + " | ".join(
+            f"{c.name} {c.calls}x {format_percentiles(c.latency, ('p50', 'p99'))}"
+            for c in used
+        ))
+
+
+@command("REPLAY", "Resend messages you missed: REPLAY SINCE <seq|timestamp>")
+async def cmd_replay(session, arg):
+    keyword, _, point = arg.partition(" ")
+    if keyword.upper() != "SINCE" or not point.strip():
+        session.outbox.send("ERR Expected: REPLAY SINCE <seq|timestamp>")
+        return
+
+    await replay_since(session, point.strip())
+
+
+def negotiate(arg):
+    return set(arg.lower().split()) & set(CAPABILITIES)
+
+
+def caps_reply(caps):
+    return f"SYS Capabilities enabled: {' '.join(sorted(caps)) or 'none'}"
+
+
+@command("CAPS", "Enable protocol extensions, e.g. CAPS batch")
+async def cmd_caps(session, arg):
+    session.caps = negotiate(arg)
+    session.outbox.batch = "batch" in session.caps
+    session.outbox.send(caps_reply(session.caps))
+
+
+@command("ADMIN", "Enter admin token")
+async def cmd_admin(session, token):
+    if token == ADMIN_TOKEN:
+        session.admin = True
+        session.outbox.send("SYS Admin privileges granted")
+        log_safe(log_file("server"), f"ADMIN_GRANTED {session.nickname}")
+    else:
+        session.outbox.send("ERR Invalid admin token")
+
+
+@command("KICK", "Kick a user by nickname", admin=True)
+async def cmd_kick(session, target):
+    target_session = sessions.find(target)
+
+    if target_session:
+        await kick(target_session)
+        return
+
+    # joined on another worker (or the old process in a handoff): its
+    # owner does the kicking
+    link = bus or predecessor
+    if link and sessions.find_remote(target):
+        link.send({"op": "kick", "nick": target})
+        return
+
+    session.outbox.send(f"ERR User not found: {target}")
+
+
+@command("RELOAD", "Re-read forbidden words and config/server.txt", admin=True)
+async def cmd_reload(session, arg):
+    try:
+        summary = await reload_config(f"admin {session.nickname}")
+    except Exception as e:
+        session.outbox.send(f"ERR Reload failed: {e}")
+        return
+
+    # the other workers re-read the same files
+    if bus:
+        bus.send({"op": "reload"})
+    session.outbox.send(f"SYS {summary}")
+
+
+@command("PROFILE", "Profile the server: PROFILE START | STOP", admin=True)
+async def cmd_profile(session, arg):
+    action = arg.upper()
+
+    if action == "START":
+        if not start_profile(f"admin {session.nickname}"):
+            session.outbox.send("ERR Profiler already running")
+            return
+        session.outbox.send(f"SYS Profiling, stops by itself after {PROFILE_MAX_SECONDS}s")
+
+    elif action == "STOP":
+        try:
+            path = await stop_profile(f"admin {session.nickname}")
+        except Exception as e:
+            session.outbox.send(f"ERR Writing the profile failed: {e}")
+            return
+        if path is None:
+            session.outbox.send("ERR Profiler not running")
+            return
+        session.outbox.send(f"SYS Profile written to logs/{os.path.basename(path)} (+ .txt)")
+
+    else:
+        session.outbox.send("ERR Expected: PROFILE START | STOP")
+
+
+async def kick(target_session):
+    name = target_session.nickname
+
+    # mark as kicked and drop from the registry right away, so
+    # WHO and new joins see it gone before the socket is closed
+    target_session.kicked = True
+    sessions.remove(target_session.ws)
+    room = leave_room(target_session)
+    link = bus or predecessor
+    if link:
+        link.send({"op": "leave", "nick": name, "room": room.name})
+    target_session.outbox.send("SYS You were kicked by an admin")
+    await target_session.outbox.close(code=4000, reason="Kicked by admin")
+
+    broadcast(f"SYS {name} was kicked by an admin")
+    log_safe(log_file("server"), f"KICK {name}")
+
+
+# ---------- admission ----------
+
+connection_cap = max(1, MAX_CONNECTIONS // WORKERS) if MAX_CONNECTIONS else 0
+connections = {}        # client address -> open connections, joined or not
+open_connections = 0    # accepted sockets, from accept to close
+upgrading = 0           # ... of them that have not sent their HTTP upgrade request yet
+
+
+class Connection(ServerConnection):
+    """A websockets connection, counted from accept to close.
+
+    Counting starts when the socket is accepted rather than when
+    handle_client runs, so sockets still in the HTTP upgrade count against
+    the cap too, and admit_request() refuses clients over it before the
+    upgrade. MAX_UPGRADING bounds how many sockets may sit before their
+    upgrade request at once (a slow-handshake flood); past that they are
+    dropped as soon as they are accepted.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.upgrading = False
+        self.ip = None  # the address it is counted against, once admitted
+
+    def connection_made(self, transport):
+        global open_connections, upgrading
+
+        super().connection_made(transport)
+        open_connections += 1
+        upgrading += 1
+        self.upgrading = True
+        if MAX_UPGRADING and upgrading > MAX_UPGRADING:
+            stats["refused_upgrading"] += 1
+            transport.abort()
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        release(self)
+
+
+def client_ip(websocket):
+    """The address a connection is counted against.
+
+    Behind a trusted proxy that is the forwarded address. None (no per-IP
+    limit) if a trusted proxy did not say, rather than putting every
+    client behind it under one cap.
+    """
+    peer = websocket.remote_address
+    ip = peer[0] if peer else None
+    if ip not in TRUSTED_PROXIES:
+        return ip
+
+    headers = websocket.request.headers
+    forwarded = headers.get("X-Real-IP") or headers.get("X-Forwarded-For", "").split(",")[-1]
+    return forwarded.strip() or None
+
+
+def admit(ip):
+    """Count a connection against its address, or return why it was refused.
+
+    The connection itself is already in open_connections.
+    """
+    if connection_cap and open_connections > connection_cap:
+        stats["refused_full"] += 1
+        return "Server full"
+    if ip is not None and MAX_PER_IP and connections.get(ip, 0) >= MAX_PER_IP:
+        stats["refused_ip"] += 1
+        return "Too many connections from your address"
+
+    if ip is not None:
+        connections[ip] = connections.get(ip, 0) + 1
+    return None
+
+
+def admit_request(connection, request):
+    """process_request hook: refuses a client over a cap before the
+    upgrade, with a 503 that says when to come back.
+    """
+    global upgrading
+
+    connection.upgrading = False
+    upgrading -= 1
+
+    ip = client_ip(connection)
+    refused = admit(ip)
+    if refused:
+        log_safe(log_file("connections"), f"REFUSED {connection.remote_address} {ip} {refused}")
+        retry = random.randint(*FULL_RETRY)
+        response = connection.respond(HTTPStatus.SERVICE_UNAVAILABLE, f"{refused}, retry in {retry}s\n")
+        response.headers["Retry-After"] = str(retry)
+        return response
+
+    connection.ip = ip
+    return None
+
+
+def release(connection):
+    global open_connections, upgrading
+
+    open_connections -= 1
+    if connection.upgrading:
+        connection.upgrading = False
+        upgrading -= 1
+
+    ip, connection.ip = connection.ip, None
+    if ip is not None:
+        if connections[ip] <= 1:
+            del connections[ip]
+        else:
+            connections[ip] -= 1
+
+
+async def reap_idle():
+    # transport pings only prove the TCP peer is alive; this drops joined
+    # clients that have not sent anything at all for IDLE_TIMEOUT
+    while True:
+        await asyncio.sleep(IDLE_CHECK_INTERVAL)
+        cutoff = time.monotonic() - IDLE_TIMEOUT
+        for session in list(sessions.by_ws.values()):
+            if session.last_active < cutoff and not session.kicked:
+                stats["idle_reaped"] += 1
+                log_safe(log_file("connections"), f"IDLE {session.nickname}")
+                session.outbox.send("ERR Idle timeout")
+                asyncio.ensure_future(session.outbox.close(code=1000, reason="Idle timeout"))
+
+
+MSG_COMMAND = COMMANDS["MSG"]
+COMMAND_HELP = {c.name: c.help for c in COMMANDS.values() if c.help and not c.admin}
+COMMAND_ADMIN = {c.name: c.help for c in COMMANDS.values() if c.help and c.admin}
+
+# ---------- client handler ----------
+
+async def handle_client(websocket):
+    # admit_request() has let it in; Connection gives the slot back on close
+    try:
+        await serve_client(websocket)
+    except ConnectionClosed:
+        # gone during the handshake
+        pass
+
+
+async def read_handshake(websocket):
+    """Frames up to NICK: returns (the NICK line, caps, REPLAY SINCE argument)."""
+    caps = NO_CAPS
+    since = None
+    raw = await websocket.recv()
+
+    # CAPS and REPLAY SINCE may come before NICK (both also work later,
+    # as commands); REPLAY then replaces the usual join replay
+    for _ in range(4):
+        if raw.startswith("CAPS "):
+            caps = negotiate(raw[5:])
+            await websocket.send(caps_reply(caps))
+        elif raw.startswith("REPLAY "):
+            since = raw[7:].strip()
+        else:
+            break
+        raw = await websocket.recv()
+
+    return raw, caps, since
+
+
+async def serve_client(websocket):
+    started = time.perf_counter()
+    peer = websocket.remote_address
+    log_safe(log_file("connections"), f"CONNECT_ATTEMPT {peer}")
+
+    await websocket.send("SYS Protocol wirechat/1\n")
+    await websocket.send(f"SYS Capabilities: {' '.join(CAPABILITIES)}")
+    await websocket.send("SYS Send: NICK <name>")
+
+    try:
+        # the deadline counts from connect, so it also covers a slow HTTP upgrade
+        remaining = HANDSHAKE_TIMEOUT - (time.perf_counter() - started)
+        raw, caps, since = await asyncio.wait_for(read_handshake(websocket), max(remaining, 0.1))
+
+    except asyncio.TimeoutError:
+        stats["handshake_timeouts"] += 1
+        log_safe(log_file("errors"), f"HANDSHAKE_TIMEOUT {peer}")
+        await websocket.send("ERR Handshake timeout")
+        await websocket.close(code=1008, reason="Handshake timeout")
+        return
+
+    except Exception as e:
+        log_safe(log_file("errors"), f"HANDSHAKE_FAIL {peer} {e}")
+        return
+
+    if not raw.startswith("NICK "):
+        await websocket.send("ERR Expected: NICK <name>")
+        log_safe(log_file("errors"), f"BAD_HANDSHAKE {peer} {raw!r}")
+        await websocket.close()
+        return
+
+    nickname = raw[5:].strip()
+
+    if not valid_nickname(nickname):
+        await websocket.send("ERR Invalid nickname")
+        log_safe(log_file("errors"), f"BAD_NICK {peer} {nickname!r}")
+        await websocket.close()
+        return
+
+    if contains_forbidden(nickname):
+        await websocket.send("ERR Nickname contains forbidden words")
+        await websocket.close()
+        return
+
+    session = Session(websocket, nickname)
+    session.caps = caps
+
+    # the hub holds the cluster-wide roster, so it decides who gets a name
+    claimed = True
+    if bus:
+        try:
+            claimed = await bus.claim(nickname)
+        except asyncio.TimeoutError:
+            await websocket.send("ERR Server busy, try again")
+            await websocket.close()
+            return
+
+    if not claimed or not sessions.add(session):
+        if claimed and bus:
+            bus.send({"op": "leave", "nick": nickname})
+        await websocket.send("ERR Nickname already in use")
+        log_safe(log_file("errors"), f"DUPLICATE_NICK {peer} {nickname}")
+        await websocket.close()
+        return
+
+    outbox = session.outbox = Outbox(websocket, nickname, batch="batch" in caps)
+    lobby = rooms[DEFAULT_ROOM]
+    enter_room(session, lobby)
+    if predecessor:
+        predecessor.send({"op": "join", "nick": nickname, "room": lobby.name})
+    log_safe(log_file("connections"), f"CONNECT {nickname} {peer}")
+    if not lobby.presence.announce(nickname, joined=True):
+        # held for a summary; the client still hears that it got in
+        outbox.send(f"SYS {nickname} joined the chat!")
+    # --- message loop ---
+    # from here on the session is registered: whatever goes wrong, the
+    # finally below has to take it out again
+    try:
+        if since is None:
+            send_replay(session, lobby)
+        else:
+            await cmd_replay(session, since)
+
+        HANDSHAKE_LATENCY.observe(time.perf_counter() - started)
+
+        async for raw in websocket:
+            # let writer tasks run between inbound frames, otherwise a busy
+            # sender can fill every outbox before any of them is drained
+            await asyncio.sleep(0)
+            stats["frames_in"] += 1
+            session.frames += 1
+            session.last_active = time.monotonic()
+
+            raw = raw.strip()
+            if len(raw) > MAX_MSG_LEN:
+                outbox.send("ERR Message too large")
+                log_safe(log_file("errors"), f"MSG_TOO_LARGE {nickname}")
+                await outbox.close(code=1009)
+                break
+
+            wait = throttle(session, raw)
+            if wait:
+                if RATE_POLICY == "disconnect":
+                    outbox.send("ERR Rate limit exceeded")
+                    await outbox.close(code=1008)
+                    break
+
+                if RATE_POLICY == "err":
+                    outbox.send(f"ERR Rate limit exceeded, retry in {wait:.1f}s")
+                    continue
+
+                # delay: stop reading until the frame is paid for; the
+                # socket buffers fill up and TCP pushes back on the sender
+                while wait:
+                    await asyncio.sleep(wait)
+                    wait = throttle(session, raw, retry=True)
+
+            if await dispatch(session, raw):
+                break
+
+    except ConnectionClosed:
+        # normal disconnect (quit, kick, network drop)
+        pass
 
     except Exception as e:
         log_safe(log_file("errors"), f"CLIENT_ERROR {nickname} {e}")
 
     finally:
-        admins.discard(websocket)
-        left = clients.pop(websocket, None)
+        outbox.stop()
+
+        # a kicked session has already been taken out by kick()
+        if sessions.remove(websocket):
+            room = leave_room(session)
+            link = bus or predecessor
+            if link:
+                link.send({"op": "leave", "nick": nickname, "room": room.name})
+            room.presence.announce(nickname, joined=False)
+
+        log_safe(
+            log_file("connections"),
+            f"DISCONNECT {nickname} after {format_uptime(time.monotonic() - session.joined)}, "
+            f"{session.frames} frames, {session.messages} messages"
+        )
 
-        if left:
-            log_safe(log_file("connections"), f"DISCONNECT {left}")
+# ---------- metrics ----------
+
+def prometheus_histogram(lines, name, histogram, labels=""):
+    sep = "," if labels else ""
+    cumulative = 0
+    for bound, n in zip(Histogram.BOUNDS, histogram.buckets):
+        cumulative += n
+        lines.append(f'{name}_bucket{{{labels}{sep}le="{bound:g}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {histogram.count}')
+    suffix = f"{{{labels}}}" if labels else ""
+    lines.append(f"{name}_sum{suffix} {histogram.sum:.6f}")
+    lines.append(f"{name}_count{suffix} {histogram.count}")
+
+
+def render_metrics():
+    """Everything STATS shows admins, in Prometheus text format."""
+    depth, deepest = outbox_depths()
+    lines = []
+
+    def metric(name, kind, help, value):
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.append(f"{name} {value}")
+
+    metric("wirechat_uptime_seconds", "gauge", "Seconds since server start",
+           f"{time.monotonic() - SERVER_START_TIME:.0f}")
+    metric("wirechat_sessions", "gauge", "Joined sessions", len(sessions))
+    metric("wirechat_rooms", "gauge", "Rooms with at least one member", len(rooms))
+    metric("wirechat_frames_in_total", "counter", "Frames received from joined clients", stats["frames_in"])
+    metric("wirechat_frames_out_total", "counter", "Frames written to clients", stats["frames_out"])
+    metric("wirechat_messages_total", "counter", "MSG/IMG lines published", stats["messages_session"])
+    metric("wirechat_outbox_queued", "gauge", "Frames waiting in all outbound queues", depth)
+    metric("wirechat_outbox_max_depth", "gauge", "Deepest outbound queue right now", deepest)
+    metric("wirechat_outbox_peak", "gauge", "Deepest outbound queue since start", stats["outbox_peak"])
+    metric("wirechat_outbox_dropped_total", "counter", "Frames dropped for slow clients", stats["outbox_dropped"])
+    metric("wirechat_outbox_lagging_total", "counter", "Times a client was marked lagging", stats["outbox_lagging"])
+    metric("wirechat_outbox_evictions_total", "counter", "Clients disconnected for being too slow",
+           stats["outbox_evictions"])
+    metric("wirechat_batch_frames_total", "counter", "Frames that carried several lines", stats["batch_frames"])
+    metric("wirechat_batch_lines_total", "counter", "Lines sent in multi-line frames", stats["batch_lines"])
+    metric("wirechat_moderation_cache_hits_total", "counter", "Moderation verdicts served from the cache",
+           stats["moderation_hits"])
+    metric("wirechat_moderation_cache_misses_total", "counter", "Moderation verdicts computed",
+           stats["moderation_misses"])
+    metric("wirechat_duplicates_total", "counter", "MSG/IMG refused as repeats", stats["duplicates"])
+    metric("wirechat_reloads_total", "counter", "Successful config reloads", stats["reloads"])
+    metric("wirechat_reload_seconds", "gauge", "How long the last config reload took",
+           f"{stats['reload_seconds']:.6f}")
+    metric("wirechat_archived_files_total", "counter", "Day logs compressed by the archiver",
+           stats["archived_files"])
+    metric("wirechat_connections", "gauge", "Open connections, joined or not", open_connections)
+    metric("wirechat_upgrading", "gauge", "Connections that have not sent their upgrade request yet", upgrading)
+    metric("wirechat_presence_coalesced_total", "counter", "Join/leave notices folded into summary lines",
+           stats["presence_coalesced"])
+    metric("wirechat_handshake_timeouts_total", "counter", "Connections that never sent NICK in time",
+           stats["handshake_timeouts"])
+    metric("wirechat_idle_reaped_total", "counter", "Joined clients dropped for being idle", stats["idle_reaped"])
+    metric("wirechat_loop_stalls_total", "counter", "Times the event loop was blocked past the lag threshold",
+           stats["loop_stalls"])
+    metric("wirechat_profiling", "gauge", "1 while a PROFILE is running", int(profiler is not None))
+    metric("wirechat_log_backlog", "gauge", "Lines waiting for the log writer", log_writer.backlog())
+    metric("wirechat_log_errors_total", "counter", "Failed log writes", log_writer.errors)
+
+    for name, help, histogram in (
+        ("wirechat_fanout_seconds", "Time from broadcast to frame written, per client", FANOUT_LATENCY),
+        ("wirechat_handshake_seconds", "Time from connect to joined", HANDSHAKE_LATENCY),
+        ("wirechat_moderation_seconds", "Time spent in the forbidden-content check", MODERATION_LATENCY),
+        ("wirechat_loop_lag_seconds", "How late the event loop ran a timer that was due", LOOP_LAG),
+    ):
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} histogram")
+        prometheus_histogram(lines, name, histogram)
+
+    lines.append("# HELP wirechat_throttled_total Inbound frames that hit a rate limit, per bucket")
+    lines.append("# TYPE wirechat_throttled_total counter")
+    for name, n in throttled.items():
+        lines.append(f'wirechat_throttled_total{{bucket="{name}"}} {n}')
+
+    lines.append("# HELP wirechat_refused_total Connections turned away, per limit")
+    lines.append("# TYPE wirechat_refused_total counter")
+    lines.append(f'wirechat_refused_total{{limit="server"}} {stats["refused_full"]}')
+    lines.append(f'wirechat_refused_total{{limit="address"}} {stats["refused_ip"]}')
+    lines.append(f'wirechat_refused_total{{limit="upgrading"}} {stats["refused_upgrading"]}')
+
+    lines.append("# HELP wirechat_command_calls_total Frames handled per command")
+    lines.append("# TYPE wirechat_command_calls_total counter")
+    for c in COMMANDS.values():
+        lines.append(f'wirechat_command_calls_total{{command="{c.name}"}} {c.calls}')
+
+    lines.append("# HELP wirechat_command_seconds Handler time per command")
+    lines.append("# TYPE wirechat_command_seconds histogram")
+    for c in COMMANDS.values():
+        prometheus_histogram(lines, "wirechat_command_seconds", c.latency, f'command="{c.name}"')
+
+    return "\n".join(lines) + "\n"
+
+
+async def serve_metrics(reader, writer):
+    # just enough HTTP for a Prometheus scrape: GET /metrics, then close
+    try:
+        request = await asyncio.wait_for(reader.readline(), timeout=5)
+        while True:
+            header = await asyncio.wait_for(reader.readline(), timeout=5)
+            if header in (b"\r\n", b"\n", b""):
+                break
 
-            if websocket in kicked:
-                kicked.discard(websocket)
-            else:
-                await broadcast(f"SYS {left} left the chat!")
+        parts = request.split()
+        if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] == b"/metrics":
+            status, body = "200 OK", render_metrics()
+        else:
+            status, body = "404 Not Found", "Not found\n"
+
+        data = body.encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            f"Connection: close\r\n\r\n".encode("ascii") + data
+        )
+        await writer.drain()
 
-# ---------- main ----------
+    except Exception as e:
+        log_safe(log_file("errors"), f"METRICS_FAIL {e}")
 
-async def main():
-    log_safe(log_file("server"), "SERVER_START")
-    print("WS server listening...")
+    finally:
+        writer.close()
+
+# ---------- cluster ----------
+#
+# WIRECHAT_WORKERS=N starts a supervisor that runs the hub and N worker
+# processes. Workers bind PORT with SO_REUSEPORT (the kernel spreads new
+# connections over them) and talk to the hub over a Unix socket with
+# newline-delimited JSON:
+#
+#   worker -> hub: hello, claim, leave, move, frame, publish, kick, stats
+#   hub -> worker: claimed, join, leave, move, frame, record, kick, stats
+#
+# The hub owns the cluster roster (nickname claims and the room each user
+# is in) and the message logs; every published record goes through it, so
+# all workers see each room's history in the same order. Workers warm a
+# room's replay buffer from its log file when the room first shows up.
+
+bus = None  # Bus, in worker processes only
+STATS_REPORT_INTERVAL = 5
+
+
+def bus_line(message):
+    return (json.dumps(message, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+class Bus:
+    """A worker's connection to the hub."""
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.reader = None
+        self.writer = None
+        self.requests = {}  # request id -> future
+        self.ids = itertools.count(1)
+        self.peers = {}  # worker id -> last stats it reported
+        self.tasks = set()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(BUS_PATH)
+        self.send({"op": "hello", "worker": self.worker_id})
+        self.spawn(self.run())
+        self.spawn(self.report())
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def send(self, message):
+        if self.writer and not self.writer.is_closing():
+            self.writer.write(bus_line(message))
+
+    async def claim(self, nickname, timeout=5):
+        rid = next(self.ids)
+        future = self.requests[rid] = asyncio.get_running_loop().create_future()
+        self.send({"op": "claim", "id": rid, "nick": nickname})
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.requests.pop(rid, None)
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(STATS_REPORT_INTERVAL)
+            self.send({
+                "op": "stats",
+                "worker": self.worker_id,
+                "sessions": len(sessions),
+                "frames_in": stats["frames_in"],
+                "frames_out": stats["frames_out"],
+            })
+
+    def handle(self, message):
+        op = message["op"]
+
+        if op == "record":
+            apply_record(Record(*message["record"]), rooms.get(message["room"]))
+
+        elif op == "frame":
+            name = message["room"]
+            skip = frozenset(message.get("skip", ()))
+            if name is None:
+                broadcast_local(message["text"], skip=skip)
+            elif name in rooms:
+                broadcast_local(message["text"], rooms[name], skip)
+
+        elif op == "join":
+            sessions.add_remote(message["nick"])
+            open_room(message["room"]).add(message["nick"])
+
+        elif op == "leave":
+            sessions.remove_remote(message["nick"])
+            self.leave_room(message["nick"], message["room"])
+
+        elif op == "move":
+            self.leave_room(message["nick"], message["from"])
+            open_room(message["room"]).add(message["nick"])
+
+        elif op == "claimed":
+            future = self.requests.get(message["id"])
+            if future and not future.done():
+                future.set_result(message["ok"])
+
+        elif op == "kick":
+            target = sessions.find(message["nick"])
+            if target:
+                self.spawn(kick(target))
+
+        elif op == "stats":
+            self.peers[message["worker"]] = message
+
+        elif op == "reload":
+            self.spawn(reload_quietly("bus"))
+
+    def leave_room(self, nickname, name):
+        room = rooms.get(name)
+        if room is not None:
+            room.discard(nickname)
+            close_room(room)
+
+    async def run(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                self.handle(json.loads(line))
+
+        except Exception as e:
+            log_safe(log_file("errors"), f"BUS_FAIL worker {self.worker_id} {e}")
+
+        finally:
+            self.lost()
+
+    def lost(self):
+        # no hub, no cluster: stop and let the supervisor start us again
+        if not stop_event.is_set():
+            log_safe(log_file("errors"), f"BUS_LOST worker {self.worker_id}")
+            request_shutdown()
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+
+class Hub:
+    """Supervisor side of the bus."""
+
+    def __init__(self):
+        self.workers = {}  # worker id -> StreamWriter
+        self.roster = {}  # case-folded nickname -> [nickname, worker id, room]
+
+    def send(self, worker_id, message):
+        writer = self.workers.get(worker_id)
+        if writer and not writer.is_closing():
+            writer.write(bus_line(message))
+
+    def send_all(self, message, exclude=None):
+        data = bus_line(message)
+        for worker_id, writer in self.workers.items():
+            if worker_id != exclude and not writer.is_closing():
+                writer.write(data)
+
+    def handle(self, worker_id, message):
+        op = message["op"]
+
+        if op == "publish":
+            record = Record(*message["record"])
+            record.seq = next(sequence)
+            persist_message(room_log(message["room"]), record.log_line())
+            stats["messages_session"] += 1
+            self.send_all({"op": "record", "room": message["room"], "record": record.pack()})
+
+        elif op == "frame":
+            self.send_all(message, exclude=worker_id)
+
+        elif op == "claim":
+            nickname = message["nick"]
+            key = nickname.casefold()
+            ok = key not in self.roster
+            if ok:
+                self.roster[key] = [nickname, worker_id, DEFAULT_ROOM]
+                self.send_all({"op": "join", "nick": nickname, "room": DEFAULT_ROOM}, exclude=worker_id)
+            self.send(worker_id, {"op": "claimed", "id": message["id"], "ok": ok})
+
+        elif op == "leave":
+            key = message["nick"].casefold()
+            entry = self.roster.get(key)
+            if entry and entry[1] == worker_id:
+                del self.roster[key]
+                self.send_all({"op": "leave", "nick": entry[0], "room": entry[2]}, exclude=worker_id)
+
+        elif op == "move":
+            entry = self.roster.get(message["nick"].casefold())
+            if entry and entry[1] == worker_id:
+                entry[2] = message["room"]
+                self.send_all(message, exclude=worker_id)
+
+        elif op == "kick":
+            entry = self.roster.get(message["nick"].casefold())
+            if entry:
+                self.send(entry[1], message)
+
+        elif op in ("stats", "reload"):
+            self.send_all(message, exclude=worker_id)
+
+    async def serve(self, reader, writer):
+        worker_id = None
+        try:
+            hello = json.loads(await reader.readline())
+            worker_id = hello["worker"]
+            self.workers[worker_id] = writer
+            log_safe(log_file("server"), f"WORKER_JOINED {worker_id}")
+
+            # bring the new worker up to date
+            for nickname, owner, room in self.roster.values():
+                if owner != worker_id:
+                    self.send(worker_id, {"op": "join", "nick": nickname, "room": room})
+
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.handle(worker_id, json.loads(line))
+
+        except Exception as e:
+            log_safe(log_file("errors"), f"HUB_FAIL worker {worker_id} {e}")
+
+        finally:
+            if self.workers.get(worker_id) is writer:
+                del self.workers[worker_id]
+
+            # a worker that died without saying goodbye leaves ghosts behind
+            ghosts = {}  # room -> nicknames
+            for key, (nickname, owner, room) in list(self.roster.items()):
+                if owner == worker_id:
+                    del self.roster[key]
+                    self.send_all({"op": "leave", "nick": nickname, "room": room})
+                    ghosts.setdefault(room, []).append(nickname)
+            for room, names in ghosts.items():
+                self.send_all({"op": "frame", "room": room, "text": presence_line(names, "left")})
+
+            writer.close()
+
+
+async def run_worker(worker_id, procs):
+    while True:
+        env = dict(os.environ, WIRECHAT_WORKER_ID=str(worker_id))
+        proc = procs[worker_id] = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), env=env
+        )
+        code = await proc.wait()
+
+        if stop_event.is_set():
+            return
+
+        log_safe(log_file("errors"), f"WORKER_EXIT {worker_id} code {code}")
+        await asyncio.sleep(1)
+
+
+async def supervise():
+    log_safe(log_file("server"), f"SERVER_START workers {WORKERS}")
+    start_sequence()
+    print(f"WS server listening with {WORKERS} workers...")
     try:
         os.remove(RESTART_FLAG)
     except FileNotFoundError:
         pass
 
+    hub = Hub()
+    try:
+        os.remove(BUS_PATH)
+    except FileNotFoundError:
+        pass
+    bus_server = await asyncio.start_unix_server(hub.serve, BUS_PATH)
+
+    procs = {}
+    runners = [asyncio.create_task(run_worker(i, procs)) for i in range(WORKERS)]
+    archiver = asyncio.create_task(run_archiver()) if ARCHIVE_INTERVAL else None
+
+    # each worker reloads its own copy of the config
+    def forward_sighup():
+        for proc in procs.values():
+            if proc.returncode is None:
+                proc.send_signal(signal.SIGHUP)
+
+    def forward_sigusr1():
+        for proc in procs.values():
+            if proc.returncode is None:
+                proc.send_signal(signal.SIGUSR1)
+
+    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, forward_sighup)
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, forward_sigusr1)
+
+    await stop_event.wait()
+
+    # workers notify and close their own clients on SIGTERM
+    for proc in procs.values():
+        if proc.returncode is None:
+            proc.terminate()
+
+    done, pending = await asyncio.wait(runners, timeout=15)
+    for proc in procs.values():
+        if proc.returncode is None:
+            proc.kill()
+    for task in pending:
+        task.cancel()
+
+    stop_archiver(archiver)
+    bus_server.close()
+    await bus_server.wait_closed()
+    try:
+        os.remove(BUS_PATH)
+    except FileNotFoundError:
+        pass
+
+    log_safe(log_file("server"), "SERVER_STOP")
+    log_writer.close()
+
+# ---------- handoff ----------
+#
+# A new server started with WIRECHAT_TAKEOVER=1 connects to HANDOFF_PATH.
+# The running one passes it the listening sockets (SCM_RIGHTS), so the port
+# is never closed, then its state as one JSON line: the next sequence
+# number, counters, every room's replay buffer and who is in it. Once the
+# new process says "ready" the old one stops accepting and keeps serving
+# its clients until they leave or HANDOFF_DRAIN runs out.
+#
+# While it drains, the old process is a worker whose hub is the new one:
+# the link speaks the bus protocol, the new process numbers and persists
+# everything, and each side sees the other's messages and presence.
+# Single-process mode only.
+
+handing_off = False  # old process: drained by a successor
+predecessor = None  # new process: Predecessor while the old one drains
+
+
+class Successor(Bus):
+    """Old process: the link to its replacement, standing in for the hub."""
+
+    def __init__(self, reader, writer):
+        super().__init__("handoff")
+        self.reader = reader
+        self.writer = writer
+        self.pending = []  # sent before the state went out
+        self.outcome = asyncio.get_running_loop().create_future()  # True once serving
+
+    def send(self, message):
+        if self.pending is not None:
+            self.pending.append(message)
+        else:
+            super().send(message)
+
+    def start(self, state):
+        self.writer.write(bus_line(state))
+        pending, self.pending = self.pending, None
+        for message in pending:
+            self.send(message)
+        self.spawn(self.run())
+
+    def handle(self, message):
+        if message["op"] == "ready":
+            if not self.outcome.done():
+                self.outcome.set_result(True)
+        else:
+            super().handle(message)
+
+    def lost(self):
+        if not self.outcome.done():
+            self.outcome.set_result(False)
+        elif not stop_event.is_set():
+            # nobody left to persist our messages
+            log_safe(log_file("errors"), "HANDOFF_LOST")
+            request_shutdown()
+
+
+class Predecessor(Bus):
+    """New process: the old one while it drains, handled like a worker."""
+
+    def __init__(self, reader, writer):
+        super().__init__("predecessor")
+        self.reader = reader
+        self.writer = writer
+
+    def handle(self, message):
+        op = message["op"]
+
+        if op == "publish":
+            publish(Record(*message["record"]), open_room(message["room"]))
+
+        elif op == "claim":
+            nickname = message["nick"]
+            ok = not sessions.find(nickname) and not sessions.find_remote(nickname)
+            if ok:
+                sessions.add_remote(nickname)
+                rooms[DEFAULT_ROOM].add(nickname)
+            self.send({"op": "claimed", "id": message["id"], "ok": ok})
+
+        elif op in ("frame", "leave", "move", "kick"):
+            message.setdefault("room", DEFAULT_ROOM)
+            super().handle(message)
+
+    def lost(self):
+        global predecessor
+        predecessor = None
+
+        # whoever was still over there has been told to reconnect
+        for nickname in list(sessions.remote.values()):
+            sessions.remove_remote(nickname)
+            for room in list(rooms.values()):
+                room.discard(nickname)
+                close_room(room)
+        log_safe(log_file("server"), "HANDOFF_DRAINED")
+
+
+def handoff_state():
+    return {
+        "op": "state",
+        "seq": next(sequence),
+        "uptime": time.monotonic() - SERVER_START_TIME,
+        "stats": stats,
+        "rooms": {
+            name: {
+                "messages": room.messages,
+                "names": room.names,
+                "history": [record.pack() for record in room.history.records],
+            }
+            for name, room in rooms.items()
+        },
+    }
+
+
+def restore_state(state):
+    global sequence, SERVER_START_TIME
+
+    sequence = itertools.count(state["seq"])
+    SERVER_START_TIME = time.monotonic() - state["uptime"]
+    stats.update(state["stats"])
+
+    for name, saved in state["rooms"].items():
+        room = rooms[name] = Room(name)
+        room.messages = saved["messages"]
+        for packed in saved["history"]:
+            room.history.append(Record(*packed))
+        for nickname in saved["names"]:
+            sessions.add_remote(nickname)
+            room.add(nickname)
+
+
+async def hand_over(conn, server, metrics_server):
+    """Old process: pass the sockets and state to whoever connected."""
+    global bus, handing_off
+
+    listeners = [server.sockets[0]] + (list(metrics_server.sockets[:1]) if metrics_server else [])
+    socket.send_fds(conn, [b"F"], [s.fileno() for s in listeners])
+    reader, writer = await asyncio.open_unix_connection(sock=conn)
+
+    # from here on publish() goes to the successor, which appends to the
+    # same log files, so ours must be on disk before it starts
+    link = bus = Successor(reader, writer)
+    handing_off = True
+    state = handoff_state()
+    await asyncio.to_thread(log_writer.sync)
+    link.start(state)
+
+    try:
+        ok = await asyncio.wait_for(asyncio.shield(link.outcome), HANDOFF_TIMEOUT)
+    except asyncio.TimeoutError:
+        ok = False
+
+    if not ok:
+        # carry on as before; whatever was sent its way in between is lost
+        bus = None
+        handing_off = False
+        link.close()
+        log_safe(log_file("errors"), "HANDOFF_FAIL")
+        return False
+
+    server.close(close_connections=False)
+    if metrics_server:
+        metrics_server.close()
+    return True
+
+
+async def serve_handoff(server, metrics_server):
+    try:
+        os.remove(HANDOFF_PATH)
+    except FileNotFoundError:
+        pass
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(HANDOFF_PATH)
+    listener.listen(1)
+    listener.setblocking(False)
+
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            conn, _ = await loop.sock_accept(listener)
+            log_safe(log_file("server"), "HANDOFF_START")
+            if await hand_over(conn, server, metrics_server):
+                break
+    finally:
+        listener.close()
+
+    log_safe(log_file("server"), f"HANDOFF_DONE {len(sessions)} clients left to drain")
+    deadline = time.monotonic() + HANDOFF_DRAIN
+    while len(sessions) and time.monotonic() < deadline:
+        await asyncio.sleep(0.5)
+    request_shutdown()
+
+
+async def take_over():
+    """New process: get the listening sockets and state from the old one."""
+    global predecessor
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(HANDOFF_TIMEOUT)
+    sock.connect(HANDOFF_PATH)
+    _, fds, _, _ = socket.recv_fds(sock, 1, 2)
+    listeners = [socket.socket(fileno=fd) for fd in fds]
+
+    # the state line holds every room's replay buffer
+    reader, writer = await asyncio.open_unix_connection(sock=sock, limit=2 ** 26)
+    state = json.loads(await reader.readline())
+    restore_state(state)
+    predecessor = Predecessor(reader, writer)
+    return listeners
+
+# ---------- main ----------
+
+async def main():
+    global bus
+
     # --- register graceful shutdown signals ---
     loop = asyncio.get_running_loop()
     for sig in (signal.SIGTERM, signal.SIGINT):
@@ -519,14 +3470,86 @@ async def main():
         except NotImplementedError:
             signal.signal(sig, lambda *_: request_shutdown())
 
+    if WORKER_ID is None and WORKERS > 1:
+        await supervise()
+        return
+
+    if hasattr(signal, "SIGHUP"):
+        loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(reload_quietly("SIGHUP")))
+    if hasattr(signal, "SIGUSR1"):
+        loop.add_signal_handler(signal.SIGUSR1, toggle_profile)
+
+    listeners = []
+    if WORKER_ID is None and TAKEOVER:
+        try:
+            listeners = await take_over()
+        except Exception as e:
+            # nothing to take over: start the normal way
+            log_safe(log_file("errors"), f"TAKEOVER_FAIL {e}")
+        else:
+            started = f"SERVER_TAKEOVER pid {os.getpid()}"
+            open_room(DEFAULT_ROOM)
+            print("WS server took over...")
+
+    if WORKER_ID is None and not listeners:
+        started = "SERVER_START"
+        start_sequence()
+        open_room(DEFAULT_ROOM)
+        print("WS server listening...")
+        try:
+            os.remove(RESTART_FLAG)
+        except FileNotFoundError:
+            pass
+    elif WORKER_ID is not None:
+        # the roster arrives from the hub
+        open_room(DEFAULT_ROOM)
+        bus = Bus(int(WORKER_ID))
+        await bus.connect()
+        started = f"WORKER_START {WORKER_ID} pid {os.getpid()}"
+
     # --- start websocket server ---
+    listen = {"sock": listeners[0]} if listeners else {"host": HOST, "port": PORT}
     server = await websockets.serve(
         handle_client,
-        HOST,
-        PORT,
+        process_request=admit_request,
+        create_connection=Connection,
         ping_interval=30,
-        ping_timeout=10
+        ping_timeout=10,
+        open_timeout=HANDSHAKE_TIMEOUT,
+        max_size=MAX_FRAME_BYTES,
+        reuse_port=bus is not None,
+        **listen
+    )
+    log_safe(
+        log_file("server"),
+        f"{started} ready in {(time.perf_counter() - STARTUP_BEGAN) * 1000:.0f}ms "
+        f"(matcher {FORBIDDEN_MATCHER.source})"
     )
+    if FORBIDDEN_MATCHER.regex is None:
+        # stale cache: build it now, off the loop, rather than in the first MSG
+        loop.run_in_executor(None, FORBIDDEN_MATCHER.compile)
+
+    # --- metrics listener ---
+    metrics_server = None
+    if len(listeners) > 1:
+        metrics_server = await asyncio.start_server(serve_metrics, sock=listeners[1])
+    elif METRICS_PORT and not listeners:
+        port = METRICS_PORT + (bus.worker_id if bus else 0)
+        metrics_server = await asyncio.start_server(serve_metrics, METRICS_HOST, port)
+
+    # --- zero-downtime restarts ---
+    handoff = None
+    if predecessor:
+        predecessor.spawn(predecessor.run())
+        predecessor.send({"op": "ready"})
+    if bus is None:
+        handoff = asyncio.create_task(serve_handoff(server, metrics_server))
+    sampler = asyncio.create_task(sample_rates())
+    watcher = asyncio.create_task(watch_config()) if CONFIG_WATCH_INTERVAL else None
+    reaper = asyncio.create_task(reap_idle()) if IDLE_TIMEOUT else None
+    lag_monitor = asyncio.create_task(LagMonitor().run()) if LOOP_LAG_INTERVAL else None
+    # the logs belong to whoever persists messages
+    archiver = asyncio.create_task(run_archiver()) if ARCHIVE_INTERVAL and bus is None else None
 
     # --- wait for shutdown signal ---
     await stop_event.wait()
@@ -538,7 +3561,36 @@ async def main():
     server.close()
     await server.wait_closed()
 
-    log_safe(log_file("server"), "SERVER_STOP")
+    sampler.cancel()
+    if watcher:
+        watcher.cancel()
+    if reaper:
+        reaper.cancel()
+    if lag_monitor:
+        lag_monitor.cancel()
+    if profiler:
+        await stop_profile("shutdown")
+    stop_archiver(archiver)
+    if handoff and not handoff.done():
+        handoff.cancel()
+        try:
+            os.remove(HANDOFF_PATH)
+        except FileNotFoundError:
+            pass
+    if metrics_server:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+
+    if handing_off:
+        bus.close()
+        log_safe(log_file("server"), "SERVER_STOP handed off")
+    elif bus:
+        bus.close()
+        log_safe(log_file("server"), f"WORKER_STOP {WORKER_ID}")
+    else:
+        log_safe(log_file("server"), "SERVER_STOP")
+    log_writer.close()
 
 
-asyncio.run(main())
+if __name__ == "__main__":
+    asyncio.run(main())